@@ -1,5 +1,6 @@
 { config
 , lib
+, pkgs
 , ...
 }: let
 
@@ -15,19 +16,24 @@ in lib.mkIf cfg.enable {
     };
 
     services.safeticket-mailer = {
-      startAt = cfg.startAt;
+      startAt = lib.mkIf (!cfg.daemon) cfg.startAt;
+      wantedBy = lib.mkIf cfg.daemon [ "multi-user.target" ];
 
       description = "Safeticket Mailer";
       after = [ "network.target" ];
       serviceConfig = {
+        Type = lib.mkIf cfg.daemon "simple";
         ExecStart = ''
           ${lib.getExe cfg.package} \
             --config-file "${cfg.configFile}" \
             --data-folder "${cfg.dataFolder}" \
             --auto-include-past \
             --use-manual-ticket \
-            --show-emails ${lib.optionalString cfg.sendEmails "--send-emails --send-invoice"}
+            --show-emails ${lib.optionalString cfg.sendEmails "--send-emails --send-invoice"} \
+            ${lib.optionalString cfg.daemon "--daemon --schedule '${cfg.schedule}'"}
         '';
+        ExecReload = lib.mkIf cfg.daemon "${pkgs.coreutils}/bin/kill -HUP $MAINPID";
+        Restart = lib.mkIf cfg.daemon "on-failure";
         EnvironmentFile = lib.mkIf (cfg.environmentFile != null) [ cfg.environmentFile ];
         User = cfg.user;
         Group = cfg.group;
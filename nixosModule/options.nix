@@ -71,10 +71,28 @@ in
         description = "Environment file, used to set any secrets";
       };
 
+      daemon = mkEnableOption ''
+        the daemon mode, where Safeticket Mailer keeps running as a `Type=simple` service
+        and makes the reports at the times in the `schedule` option, instead of being started by a timer.
+        The login, the workers and the ticket store are then kept in memory between the runs.
+        The config file is read again with `systemctl reload safeticket-mailer`
+      '';
+
+      schedule = mkOption {
+        type = str;
+        default = "0 7 * * 1";
+        description = ''
+          When to make the reports in the daemon mode, as a cron expression with 5 fields:
+          minute, hour, day of the month, month and day of the week.
+          The default is every Monday at 07:00 (AM).
+        '';
+        example = "0 7 * * mon-fri";
+      };
+
       startAt = mkOption {
         type = either (str) (listOf str);
         description = ''
-          When to start the Safeticket Mailer service.
+          When to start the Safeticket Mailer service, it is not used in the daemon mode.
           The example shows how to start it every Monday at 07:00 (AM).
 
           Read more the configuring
@@ -20,7 +20,6 @@ buildPythonPackage rec {
     pyyaml
     tabulate
     jinja2
-    odfpy
     requests
   ];
 
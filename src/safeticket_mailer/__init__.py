@@ -1,64 +1,233 @@
 #!/usr/bin/env python3
 # ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
-import json
 import re
 import sys
-from csv import DictReader
-from datetime import datetime, timedelta, date, timezone, UTC
+import unittest
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, date, timezone
 from io import StringIO
 from pathlib import Path
 from pprint import pprint as pp
-from typing import List
-
-import yaml
-from tabulate import tabulate
+from time import perf_counter
+from typing import Any, Dict, List, TextIO, Tuple, Optional
 
+from .lib.artifact_cache import ArtifactCache
 from .lib.config import get_config
-from .lib.invoice import Invoice, TicketInfo
-from .lib.misc import args_parser, show_email, send_email, TicketTypesType, \
-    create_spreadsheet_grouped_by_ticket_type_data, MemoryFile, create_spreadsheet_grouped_by_buyer_data
-from .lib.safeticket_wrapper import SafeTicket
+from .lib.metrics import Metrics
+from .lib.misc import DEFAULT_SCHEDULE, args_parser, show_email, send_email, get_ticket_columns, read_tickets_csv, \
+    MemoryFile, SpreadsheetPool, SMTPTransport
+from .lib.outbox import Outbox, OutboxWorker, SentState
+from .lib.pdf_renderer import PdfRenderer
+from .lib.ticket_store import TicketStore
+from .lib.ticket_table import TicketTable, TicketIndex, discount_percent
+
+# The modules there is slow to import are imported where they are used, so they are only imported when they are
+# needed, like jinja2 is only imported when an invoice is made. `TestImport` checks they stay that way
+LAZY_MODULES = ["jinja2", "yaml", "tabulate", "requests"]
+
+
+class Services:
+    """
+    The sessions, workers and stores there is used by the runs. With `--daemon` they are kept between the runs,
+    so a run doesn't have to log in, start the workers or read the ticket stores from the disk again.
+    """
+    config: Any
+    outbox: Outbox
+    pdf_renderer: PdfRenderer
+    smtp_transport: SMTPTransport
+    ticket_stores: Dict[int, TicketStore]
+
+    def __init__(self, args, config):
+        self._args = args
+        self._login = None
+        self._outbox_worker: Optional[OutboxWorker] = None
+        self.safe_ticket = None
+        self.smtp_transport = None
+
+        self.outbox = Outbox(Path(args.data_folder).joinpath("outbox"))
+        self.pdf_renderer = PdfRenderer(workers=args.jobs)
+        # The ticket stores by the id of the event
+        self.ticket_stores = {}
+        self.reload(config)
+
+    def reload(self, config):
+        """Use the config from now on, the session with SafeTicket is kept if the login is the same"""
+        from .lib.safeticket_wrapper import SafeTicket, SessionStore
+
+        login = (config.organization, config.username, config.password,
+                 getattr(config, 'safeticket_encoding', 'utf-8'), getattr(config, 'safeticket_url', None))
+        if login != self._login:
+            self.safe_ticket = SafeTicket(
+                *login[:3], encoding=login[3], debug=self._args.debug,
+                session_store=SessionStore(Path(self._args.data_folder).joinpath("safeticket-session.json")),
+                base_url=login[4], record_folder=self._args.record, replay_folder=self._args.replay)
+            self._login = login
+
+        self._stop_outbox_worker()
+        self.config = config
+        self.smtp_transport = SMTPTransport(config=config)
+
+    def start_outbox_worker(self):
+        """Send the emails in the outbox in the background, in the same SMTP session"""
+        if self._outbox_worker is None:
+            self._outbox_worker = OutboxWorker(self.outbox, self.smtp_transport,
+                                               max_attempts=self._args.outbox_max_attempts, debug=self._args.debug)
+            self._outbox_worker.start()
+
+    def _stop_outbox_worker(self) -> List[Tuple[str, Dict[str, Any]]]:
+        remaining = []
+        if self._outbox_worker is not None:
+            remaining = self._outbox_worker.close()
+            self._outbox_worker = None
+        if self.smtp_transport is not None:
+            self.smtp_transport.close()
+        return remaining
+
+    def close(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Return: The emails there is still in the outbox"""
+        self.pdf_renderer.close()
+        return self._stop_outbox_worker()
 
 
 def main():
     args = args_parser()
 
+    if args.daemon:
+        run_daemon(args)
+        return
+
     CONFIG = get_config(args.config_file)
 
-    safe_ticket = SafeTicket(
-        CONFIG.organization,
-        CONFIG.username,
-        CONFIG.password)
+    var_folder_path = Path(args.data_folder)
+    outbox = Outbox(var_folder_path.joinpath("outbox"))
+
+    if args.flush_outbox:
+        with SMTPTransport(config=CONFIG) as smtp_transport:
+            remaining = outbox.flush(smtp_transport, max_attempts=args.outbox_max_attempts, debug=args.debug)
+        if remaining:
+            print(f"============({len(remaining)} emails could not be sent, "
+                  f"they are still in the outbox: {outbox.folder})============", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    services = Services(args, CONFIG)
+    metrics = Metrics()
+    try:
+        run_reports(args, services, metrics)
+        metrics.success = True
+    finally:
+        # The emails in the outbox are sent, before the metrics of the run are written
+        remaining = services.close()
+        write_metrics(args, services, metrics)
+
+    if remaining:
+        print(f"============({len(remaining)} emails could not be sent, they are still in the outbox "
+              f"and can be sent with --flush-outbox)============", file=sys.stderr)
+        sys.exit(1)
+
+
+def get_schedule(args, config) -> "CronSchedule":
+    from .lib.scheduler import CronSchedule
+    return CronSchedule(args.schedule or getattr(config, 'schedule', DEFAULT_SCHEDULE))
+
+
+def run_daemon(args):
+    """
+    Keep running and make the reports each time the schedule says so (`--schedule`). The SafeTicket session,
+    the invoice template, the threads of the PDF renderer and the ticket stores are kept in memory between the runs.
+    The config file is read again on SIGHUP, and it stops after the current run on SIGTERM or SIGINT.
+    """
+    from .lib.scheduler import Scheduler
+
+    services = Services(args, get_config(args.config_file))
+
+    def reload():
+        config = get_config(args.config_file)
+        # Check the schedule before the config is used
+        schedule = get_schedule(args, config)
+        services.reload(config)
+        return schedule
+
+    def job():
+        metrics = Metrics()
+        try:
+            run_reports(args, services, metrics)
+            metrics.success = True
+        finally:
+            write_metrics(args, services, metrics)
+
+    try:
+        Scheduler(get_schedule(args, services.config), job=job, reload=reload).run()
+    finally:
+        remaining = services.close()
+
+    if remaining:
+        print(f"============({len(remaining)} emails could not be sent, they are still in the outbox "
+              f"and are sent in the next run)============", file=sys.stderr)
+
+
+def write_metrics(args, services: Services, metrics: Metrics):
+    """
+    Add the requests to SafeTicket and the emails sent since the last run to the metrics, and write them
+    to the data folder. With --debug the time of each phase is printed
+    """
+    stats = services.safe_ticket.stats
+    metrics.count("safeticket_requests", stats.requests)
+    metrics.count("safeticket_retries", stats.retries)
+    metrics.count("safeticket_timeouts", stats.timeouts)
+    metrics.count("safeticket_wait_seconds", stats.wait_time)
+    stats.reset()
+
+    latencies = services.smtp_transport.take_latencies()
+    metrics.count("emails_sent", len(latencies))
+    if latencies:
+        metrics.add_time("smtp_send", sum(latencies))
+
+    metrics.finish()
+    metrics.write(Path(args.data_folder))
+
+    if args.debug:
+        print("\n============(Metrics)============")
+        print(metrics.breakdown())
+
+
+def run_reports(args, services: Services, metrics: Metrics):
+    """
+    One run: Sync the tickets from SafeTicket, and create (and send) the reports for the unions
+    :param metrics: Where the time of each phase of the run is added
+    """
+    CONFIG = services.config
+    safe_ticket = services.safe_ticket
+    outbox = services.outbox
+    var_folder_path = Path(args.data_folder)
 
-    if safe_ticket.login() is False:
+    with metrics.timer("login"):
+        is_logged_in = safe_ticket.login()
+    if is_logged_in is False:
         print("Something when wrong with login to SafeTicket")
         exit(1)
 
-    var_folder_path = Path(args.data_folder)
     var_event_folder_path = var_folder_path.joinpath(CONFIG.event_name)
     var_event_run_folder_path = var_event_folder_path.joinpath("progress_status")
     var_event_run_folder_path.mkdir(parents=True, exist_ok=True)
 
-    sent_invoice_mail_path = var_event_run_folder_path.joinpath("sent-invoice-mail.json")
-    if not sent_invoice_mail_path.is_file():
-        sent_invoice_mail_path.write_text(json.dumps([], indent=4))
-
-    sent_last_status_mail_path = var_event_run_folder_path.joinpath("sent-last-status-mail.json")
-    if not sent_last_status_mail_path.is_file():
-        sent_last_status_mail_path.write_text(json.dumps([], indent=4))
+    sent_state = SentState(var_event_run_folder_path)
 
-    sent_status_mail_path = var_event_run_folder_path.joinpath("sent-status-mail.json")
-    if not sent_status_mail_path.is_file():
-        sent_status_mail_path.write_text(json.dumps({}, indent=4))
+    if args.generate_invoice or args.send_invoice:
+        from .lib.invoice import check_html_to_pdf, set_template_cache_folder
+        check_html_to_pdf()
+        set_template_cache_folder(var_folder_path.joinpath("template-cache"))
 
     # Look through all the events and find the one we need
-    events = safe_ticket.get_events(past=args.past)
+    with metrics.timer("event_lookup"):
+        events = safe_ticket.get_events(past=args.past)
 
-    if args.auto_include_past is True and args.past is False:
-        _past_events = safe_ticket.get_events(past=True)
-        events.data.events += _past_events.data.events
+        if args.auto_include_past is True and args.past is False:
+            _past_events = safe_ticket.get_events(past=True)
+            events.data.events += _past_events.data.events
 
     if args.events or args.debug:
+        import yaml
         print(yaml.safe_dump([e.__dict__ for e in events.data.events]))
 
     _event = [event for event in events.data.events
@@ -71,32 +240,77 @@ def main():
         sys.exit(2)
 
     # Get all the data about ticket types from the selected `event`
-    tickets = safe_ticket.get_event_tickets(event.id)
+    with metrics.timer("ticket_types"):
+        tickets = safe_ticket.get_event_tickets(event.id)
 
     # Filter the ticket types IDs into a list
-    ticket_ids = []
+    ticket_ids = [ticket.id for ticket in tickets.data.tickets]
 
-    # Contains all the ticket types and how many there have been sold of them
-    ticket_types: TicketTypesType = {}
-    for ticket in tickets.data.tickets:
-        ticket_ids.append(ticket.id)
-        ticket_types[ticket.name] = []
+    # Only the fields of the tickets there is used in the config file is read from the export
+    ticket_columns = get_ticket_columns(CONFIG)
 
-    # Export ticket stats from the event into a CSV file
-    csv_content = safe_ticket.export_tickets_stats(event.id, ticket_ids)
+    # Only export all the tickets again, if something have changed since the last run
+    # With --daemon the ticket store from the last run is still in memory
+    ticket_store = services.ticket_stores.get(event.id)
+    is_loaded = ticket_store is not None and set(ticket_columns) <= ticket_store.table.columns.keys()
+    if not is_loaded:
+        ticket_store = TicketStore(var_event_folder_path.joinpath("ticket-store"), event.id)
+        services.ticket_stores[event.id] = ticket_store
 
-    # Parse the CSV file
-    _csv_reader = DictReader(
-        StringIO(csv_content),
-        skipinitialspace=True,
-        delimiter=';',
-        quotechar='"')
+    if (not args.full_export and (is_loaded or ticket_store.load(columns=ticket_columns)) and
+            ticket_store.is_up_to_date(tickets_sold=event.tickets_sold, turnover_total=event.turnover_total,
+                                       max_age=timedelta(hours=args.ticket_store_max_age))):
+        if args.debug:
+            print(f"[DEBUG] Using the local ticket store from {ticket_store.synced_at}, nothing have changed")
 
-    # Doing counting of the tickets
-    for row in _csv_reader:
-        ticket_types[row['Billettype']].append(row)
+    else:
+        # Export ticket stats from the event as a CSV file, which is parsed while it is downloaded
+        export_start_time = perf_counter()
+        receive_time, received_bytes = safe_ticket.stats.receive_time, safe_ticket.stats.received_bytes
+        try:
+            csv_fieldnames, csv_rows = read_tickets_csv(
+                safe_ticket.stream_tickets_stats(event.id, ticket_ids), columns=ticket_columns)
+        except KeyError as e:
+            print("ERROR: The fields {} doesn't exist, "
+                  "check the variable 'ticket_fields' in the config.py file".format(e))
+            sys.exit(1)
+
+        sync_result = ticket_store.merge(
+            fieldnames=csv_fieldnames,
+            columns=ticket_columns,
+            rows=csv_rows,
+            tickets_sold=event.tickets_sold,
+            turnover_total=event.turnover_total)
+
+        # The time it took to receive the export, and the rest of the time it was parsed and merged
+        receive_time = safe_ticket.stats.receive_time - receive_time
+        metrics.add_time("export_download", receive_time)
+        metrics.add_time("export_parse", perf_counter() - export_start_time - receive_time)
+        metrics.count("export_bytes", safe_ticket.stats.received_bytes - received_bytes)
+        metrics.count("export_rows", ticket_store.table.row_count)
+
+        with metrics.timer("ticket_store_save"):
+            ticket_store.save()
+
+        if sync_result.duplicates:
+            print("WARNING: The export from SafeTicket have {} rows with a ticket number there is already in it, "
+                  "only the first of them is used: {}".format(len(sync_result.duplicates),
+                                                              ", ".join(sync_result.duplicates[:10])),
+                  file=sys.stderr)
+
+        if args.debug:
+            print("[DEBUG] Exported all the tickets, new: {}, changed: {}, removed: {}".format(*sync_result))
+
+    ticket_fieldnames = ticket_store.fieldnames
+
+    # Contains all the ticket types and the tickets there have been sold of them. The manual tickets are added
+    # to a copy, so they are not in the ticket store, which is used again by the next run with --daemon
+    ticket_types: TicketTable = ticket_store.table.copy() if args.manual_ticket else ticket_store.table
+    for ticket in tickets.data.tickets:
+        ticket_types.add_ticket_type(ticket.name)
 
     if args.manual_ticket:
+        import yaml
         manual_ticket_template_filename = "manual-ticket-template.yaml"
         var_event_manual_ticket_folder_path = var_event_folder_path.joinpath("manual-ticket")
         var_event_manual_ticket_folder_path.mkdir(parents=True, exist_ok=True)
@@ -105,7 +319,7 @@ def main():
                               'Betalingstype': "Cash/MobilePay", 'Status': "Betalt"}
 
         manual_ticket_all_fields = {
-            **{field_name: '' for field_name in _csv_reader.fieldnames},
+            **{field_name: '' for field_name in ticket_fieldnames},
             'Tidspunkt': datetime.fromtimestamp(event.event_ts, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"),
             **default_attributes,
         }
@@ -138,7 +352,7 @@ def main():
 
             if manual_ticket_data["Billettype"] in ticket_types:
                 manual_ticket_data["Billetnummer"] = manual_ticket.name
-                ticket_types[manual_ticket_data["Billettype"]].append(manual_ticket_data)
+                ticket_types.append(manual_ticket_data)
             else:
                 print(f"The ticket type (Billettype) is wrong in the ticket: {manual_ticket}")
                 exit(1)
@@ -148,200 +362,276 @@ def main():
         pp(sorted(ticket_types.keys()))
     if args.ticket_fields or args.debug:
         print('\n===(All The Possible Fields of The Tickets)====')
-        pp(sorted(_csv_reader.fieldnames))
+        pp(sorted(ticket_fieldnames))
     if args.ticket_stats or args.debug:
         print('\n================(Ticket Stats - Total: {})================='.format(
             sum(map(lambda x: len(x), ticket_types.values()))))
         pp([{k: len(v)} for k, v in ticket_types.items()])
 
-    for index, union in enumerate(CONFIG.unions):
-        fields = CONFIG.ticket_fields + union.ticket_fields_extra
-        ticket_info_text = []
-        for ticket_type_name in union.ticket_type_names:
-            try:
-                if ticket_types[ticket_type_name]:
-                    data = []
-                    for ticket in ticket_types[ticket_type_name]:
-                        data.append([ticket[field] for field in fields])
-
-                    ticket_info_text.append('{}:\n{}\nAntal billet solgt: {}'.format(
-                        ticket_type_name,
-                        tabulate(data, headers=fields),
-                        len(ticket_types[ticket_type_name]),
-                    ))
-            except KeyError as e:
-                print("ERROR: The fields {} doesn't exist, "
-                      "check the variable 'ticket_fields' in the config.py file".format(e))
-                sys.exit(1)
-
-        msg_status = CONFIG.email_template_status.format(
-            to_name=union.to_name,
-            from_name=union.from_name,
-            union_name=union.name,
-            ticket_info_text=(
-                '\n\n'.join(ticket_info_text) if ticket_info_text else CONFIG.email_template_status_no_ticket
-            ),
-            extra_text=union.extra_text)
-
-        tickets_grouped_by_type_file = (
-            create_spreadsheet_grouped_by_ticket_type_data(union=union, ticket_types=ticket_types, config=CONFIG)
-            if ticket_info_text else None)
-        tickets_grouped_by_buyer_file = (
-            create_spreadsheet_grouped_by_buyer_data(union=union, ticket_types=ticket_types, config=CONFIG)
-            if ticket_info_text else None)
-
-        if args.show_emails or args.debug:
-            if not union.ticket_type_names:
-                print("============(Mail - {})============".format(union.name))
-                print(f"Info: No status email was created for the union: {union.name}")
-                print(f"Reason: There are not set any ticket (ticket_type_names) in the config file for the union")
+    # All the reports below read the tickets from this index
+    with metrics.timer("index"):
+        ticket_index = TicketIndex(ticket_types, unions=CONFIG.unions)
+
+    # The unions are handled at the same time in threads, but the output of each union
+    # is buffered and printed in the same order as the unions are in the config file
+    # The spreadsheets and invoices there is made from the same data as in an earlier run are reused
+    artifact_cache = None
+    if args.artifact_cache:
+        artifact_cache = ArtifactCache(var_folder_path.joinpath("artifact-cache"),
+                                       max_size=args.artifact_cache_size * 1024 * 1024)
+
+    # The worker processes are not needed, when the spreadsheets are not built
+    spreadsheet_pool = SpreadsheetPool(jobs=args.jobs if args.send_emails or args.save_spreadsheets else 1,
+                                       ticket_index=ticket_index, config=CONFIG, artifact_cache=artifact_cache,
+                                       metrics=metrics)
+    # The emails are written to the outbox and sent in the background, while the reports for the other unions
+    # are created
+    services.start_outbox_worker()
+    outputs = [StringIO() for _ in CONFIG.unions]
+    try:
+        with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+            futures = [
+                executor.submit(
+                    create_and_send_union_report,
+                    index=index, union=union, args=args, config=CONFIG, event=event, ticket_index=ticket_index,
+                    spreadsheet_pool=spreadsheet_pool, pdf_renderer=services.pdf_renderer,
+                    artifact_cache=artifact_cache,
+                    outbox=outbox,
+                    sent_state=sent_state, metrics=metrics, out=output)
+                for index, (union, output) in enumerate(zip(CONFIG.unions, outputs))
+            ]
+
+            for future, output in zip(futures, outputs):
+                # Wait for the union to be done, even if it failed, so its output comes before the error
+                wait([future])
+                print(output.getvalue(), end='')
+                future.result()
+
+    finally:
+        spreadsheet_pool.close()
+        # The waiting processes are not kept until the next run, which is often days later
+        services.pdf_renderer.stop_warm()
+
+
+def create_and_send_union_report(index: int, union, args, config, event, ticket_index: TicketIndex,
+                                 spreadsheet_pool: SpreadsheetPool, pdf_renderer: PdfRenderer,
+                                 artifact_cache: Optional[ArtifactCache], outbox: Outbox, sent_state: SentState,
+                                 metrics: Metrics, out: TextIO):
+    """Create the status email, spreadsheets and invoice for one union and send them, if they should be sent"""
+    fields = config.ticket_fields + union.ticket_fields_extra
+    ticket_info_text = []
+    for ticket_type_name in union.ticket_type_names:
+        try:
+            tickets_of_type = ticket_index.ticket_type(ticket_type_name)
+            if tickets_of_type:
+                ticket_info_text.append('{}:\n{}\nAntal billet solgt: {}'.format(
+                    ticket_type_name,
+                    ticket_index.ticket_type_text(ticket_type_name, fields),
+                    len(tickets_of_type),
+                ))
+        except KeyError as e:
+            print("ERROR: The fields {} doesn't exist, "
+                  "check the variable 'ticket_fields' in the config.py file".format(e), file=out)
+            sys.exit(1)
+
+    msg_status = config.email_template_status.format(
+        to_name=union.to_name,
+        from_name=union.from_name,
+        union_name=union.name,
+        ticket_info_text=(
+            '\n\n'.join(ticket_info_text) if ticket_info_text else config.email_template_status_no_ticket
+        ),
+        extra_text=union.extra_text)
+
+    tickets_grouped_by_type_file = None
+    tickets_grouped_by_buyer_file = None
+    if ticket_info_text:
+        # The spreadsheets are only built when they are used, so showing the emails doesn't build them
+        tickets_grouped_by_type_file = spreadsheet_pool.file("grouped-by-type", union_index=index)
+        tickets_grouped_by_buyer_file = spreadsheet_pool.file("grouped-by-buyer", union_index=index)
+
+        if args.save_spreadsheets:
+            tickets_grouped_by_type_file.prepare()
+            tickets_grouped_by_buyer_file.prepare()
+            Path(f"/tmp/grouped-by-type.{union.name}.ods").write_bytes(tickets_grouped_by_type_file.data)
+            Path(f"/tmp/grouped-by-buyer.{union.name}.ods").write_bytes(tickets_grouped_by_buyer_file.data)
+
+    if args.show_emails or args.debug:
+        if not union.ticket_type_names:
+            print("============(Mail - {})============".format(union.name), file=out)
+            print(f"Info: No status email was created for the union: {union.name}", file=out)
+            print(f"Reason: There are not set any ticket (ticket_type_names) in the config file for the union",
+                  file=out)
 
-            else:
-                show_email(msg=msg_status, union=union,
-                           subject=union.invoice_subject, cc_emails=[union.cc_email],
-                           attachments=[tickets_grouped_by_type_file, tickets_grouped_by_buyer_file])
+        else:
+            show_email(msg=msg_status, union=union,
+                       subject=union.invoice_subject, cc_emails=[union.cc_email],
+                       attachments=[tickets_grouped_by_type_file, tickets_grouped_by_buyer_file], file=out)
 
-        if args.send_emails:
-            if not union.ticket_type_names:
-                print(f"No status email was sent to {union.name}, "
-                      f"because there are not set any ticket (ticket_type_names) in the config file for the union")
+    if args.send_emails:
+        if not union.ticket_type_names:
+            print(f"No status email was sent to {union.name}, "
+                  f"because there are not set any ticket (ticket_type_names) in the config file for the union",
+                  file=out)
 
-            else:
-                if datetime.strptime(event.settle_date, "%d.%m.%Y").date() + timedelta(
-                        days=CONFIG.send_last_status_mail_days_after_event) <= date.today():
-
-                    send_last_status_update: List[str] = json.loads(sent_last_status_mail_path.read_text())
-                    if union.name in send_last_status_update:
-                        print(f'============(The last status email was already sent to {union.name})============')
-                    else:
-                        send_email(msg=msg_status, union=union, cc_emails=[union.cc_email],
-                                   bcc_emails=[union.cc_email],
-                                   attachments=[tickets_grouped_by_type_file, tickets_grouped_by_buyer_file],
-                                   config=CONFIG, overwrite_email_receiver=args.overwrite_email_receiver)
-                        send_last_status_update.append(union.name)
-                        sent_last_status_mail_path.write_text(json.dumps(send_last_status_update, indent=4))
+        else:
+            if datetime.strptime(event.settle_date, "%d.%m.%Y").date() + timedelta(
+                    days=config.send_last_status_mail_days_after_event) <= date.today():
+
+                if sent_state.is_sent("last-status", union.name):
+                    print(f'============(The last status email was already sent to {union.name})============',
+                          file=out)
+                elif outbox.is_queued(sent_state, "last-status", union.name):
+                    print(f'============(The last status email to {union.name} is already in the outbox)============',
+                          file=out)
                 else:
-                    sent_status_update = json.loads(sent_status_mail_path.read_text())
                     send_email(msg=msg_status, union=union, cc_emails=[union.cc_email],
-                               bcc_emails=[],
+                               bcc_emails=[union.cc_email],
                                attachments=[tickets_grouped_by_type_file, tickets_grouped_by_buyer_file],
-                               config=CONFIG, overwrite_email_receiver=args.overwrite_email_receiver)
-                    sent_status_update.setdefault(union.name, [])
-                    sent_status_update[union.name].append(datetime.now(UTC).isoformat())
-                    sent_status_mail_path.write_text(json.dumps(sent_status_update, indent=4))
-
-        if args.send_invoice:
-            args.generate_invoice = '/tmp/safe_ticket'
-            Path(args.generate_invoice).mkdir(0o700, parents=True, exist_ok=True)
-
-        memory_file_invoice = None
-        if args.generate_invoice:
-            _tickets = {}
-            for ticket_type_name in union.ticket_type_names:
-                _all_ticket_of_one_type = ticket_types[ticket_type_name]
-                if _all_ticket_of_one_type:
-                    price: str = _all_ticket_of_one_type[0]['Pris']
-                    _tickets[ticket_type_name] = TicketInfo(
-                        selling_price=float(price.replace('.', '').replace(',', '.')),
-                        discount_percent=int(re.search(r'(\d+) *%', ticket_type_name).group(1)),
-                        sold_tickets=len(_all_ticket_of_one_type),
-                    )
-
-            folder = Path(args.generate_invoice).resolve()
-            invoice = Invoice(
-                title=CONFIG.event_name,
-                invoice_no=index + 1,
-                invoice_no_prefix=CONFIG.invoice_no_prefix,
-                sender_name=CONFIG.invoice_sender_name,
-                sender_cvr_no=CONFIG.invoice_sender_cvr_no,
-                sender_email=CONFIG.invoice_contact_email,
-                from_address=CONFIG.invoice_sender_address,
-                from_zip_code=CONFIG.invoice_sender_zip_code,
-                from_city=CONFIG.invoice_sender_city,
-                receiver_name=union.name,
-                receiver_cvr_no=union.invoice_cvr_no,
-                to_address=union.invoice_address,
-                to_zip_code=union.invoice_zip_code,
-                to_city=union.invoice_city,
-                registration_no=CONFIG.invoice_registration_no,
-                account_no=CONFIG.invoice_account_no,
-            )
+                               config=config, overwrite_email_receiver=args.overwrite_email_receiver,
+                               outbox=outbox, sent_state=sent_state, sent_kind="last-status")
+            else:
+                # A status email from an earlier run there is still not delivered is replaced, it is out of date
+                if outbox.discard(sent_state, "status", union.name):
+                    print(f'============(The status email to {union.name} in the outbox is replaced)============',
+                          file=out)
+                send_email(msg=msg_status, union=union, cc_emails=[union.cc_email],
+                           bcc_emails=[],
+                           attachments=[tickets_grouped_by_type_file, tickets_grouped_by_buyer_file],
+                           config=config, overwrite_email_receiver=args.overwrite_email_receiver,
+                           outbox=outbox, sent_state=sent_state, sent_kind="status")
+
+    memory_file_invoice = None
+    if args.generate_invoice or args.send_invoice:
+        from .lib.invoice import Invoice, TicketInfo
+        _tickets = {}
+        for ticket_type_name in union.ticket_type_names:
+            _all_ticket_of_one_type = ticket_index.ticket_type(ticket_type_name)
+            if _all_ticket_of_one_type:
+                _tickets[ticket_type_name] = TicketInfo(
+                    selling_price=float(_all_ticket_of_one_type[0].typed('Pris')),
+                    discount_percent=discount_percent(ticket_type_name),
+                    sold_tickets=len(_all_ticket_of_one_type),
+                )
+
+        invoice = Invoice(
+            title=config.event_name,
+            invoice_no=index + 1,
+            invoice_no_prefix=config.invoice_no_prefix,
+            sender_name=config.invoice_sender_name,
+            sender_cvr_no=config.invoice_sender_cvr_no,
+            sender_email=config.invoice_contact_email,
+            from_address=config.invoice_sender_address,
+            from_zip_code=config.invoice_sender_zip_code,
+            from_city=config.invoice_sender_city,
+            receiver_name=union.name,
+            receiver_cvr_no=union.invoice_cvr_no,
+            to_address=union.invoice_address,
+            to_zip_code=union.invoice_zip_code,
+            to_city=union.invoice_city,
+            registration_no=config.invoice_registration_no,
+            account_no=config.invoice_account_no,
+        )
 
-            pdf_file_path = folder.joinpath("{}.pdf".format(re.sub(r'[^\w ]', '', union.name)))
-            send_invoice = invoice.generate_html(
-                pdf_output_file=pdf_file_path,
+        # The invoice is only written to disk, when there is a folder for it
+        pdf_filename = "{}.pdf".format(re.sub(r'[^\w ]', '', union.name))
+        with metrics.timer("invoice", union=union.name):
+            pdf = invoice.generate_html(
+                pdf_output_file=Path(args.generate_invoice).resolve().joinpath(pdf_filename)
+                if args.generate_invoice else None,
                 additional_sponsorship=union.additional_sponsorship,
-                currency=CONFIG.currency,
+                currency=config.currency,
                 tickets=_tickets,
+                renderer=pdf_renderer,
+                file=out,
+                artifact_cache=artifact_cache,
             )
 
-            if send_invoice:
-                memory_file_invoice = MemoryFile(filename=pdf_file_path.name, data=pdf_file_path.read_bytes())
+        if pdf:
+            memory_file_invoice = MemoryFile(filename=pdf_filename, data=pdf)
 
-        if memory_file_invoice:
-            msg_invoice = CONFIG.email_template_invoice.format(
-                to_name=union.to_name,
-                from_name=union.from_name,
-                event_name=CONFIG.event_name,
-                union_name=union.name,
-                extra_text=union.extra_text)
-        else:
-            msg_invoice = CONFIG.email_template_no_invoice.format(
-                to_name=union.to_name,
-                from_name=union.from_name,
-                event_name=CONFIG.event_name,
-                union_name=union.name,
-                extra_text=union.extra_text)
-
-        if args.generate_invoice or args.debug:
-            _tmp_memory_file = None
-            if memory_file_invoice:
-                _tmp_memory_file = MemoryFile(filename=f"{args.generate_invoice}/{memory_file_invoice.filename}",
-                                              data=memory_file_invoice.data)
-            show_email(msg=msg_invoice, union=union,
-                       subject=union.invoice_subject, cc_emails=[union.cc_email, CONFIG.invoice_cc_email],
-                       attachments=[_tmp_memory_file])
-
-        if args.send_invoice:
-            settle_date = datetime.strptime(event.settle_date, "%d.%m.%Y").date()
-            if settle_date + timedelta(days=CONFIG.send_invoice_mail_days_after_event) <= date.today():
-                date_there_last_status_mail_is_sent = settle_date + timedelta(
-                    days=CONFIG.send_last_status_mail_days_after_event)
-
-                if union.ticket_type_names and date_there_last_status_mail_is_sent > date.today():
-                    print(f'============(The invoice email cannot be sent to {union.name}, '
-                          f'because the last ticket status email is not sent yet. '
-                          f'The invoice can be sent on the {date_there_last_status_mail_is_sent} or '
-                          f'after that date)============')
+    if memory_file_invoice:
+        msg_invoice = config.email_template_invoice.format(
+            to_name=union.to_name,
+            from_name=union.from_name,
+            event_name=config.event_name,
+            union_name=union.name,
+            extra_text=union.extra_text)
+    else:
+        msg_invoice = config.email_template_no_invoice.format(
+            to_name=union.to_name,
+            from_name=union.from_name,
+            event_name=config.event_name,
+            union_name=union.name,
+            extra_text=union.extra_text)
 
-                else:
-                    sent_invoice_mail: List[str] = json.loads(sent_invoice_mail_path.read_text())
-                    if union.name in sent_invoice_mail:
-                        print(f'============(The invoice email was already sent to {union.name})============')
-                    else:
-                        send_email(
-                            msg=msg_invoice,
-                            union=union,
-                            cc_emails=[
-                                union.cc_email,
-                                CONFIG.invoice_cc_email
-                            ],
-                            bcc_emails=[
-                                union.from_email
-                            ],
-                            attachments=[memory_file_invoice],
-                            config=CONFIG,
-                            overwrite_email_receiver=args.overwrite_email_receiver,
-                        )
-                        print(f'============(The invoice email was already sent to {union.name})============')
-                        sent_invoice_mail.append(union.name)
-                        sent_invoice_mail_path.write_text(json.dumps(sent_invoice_mail, indent=4))
+    if args.generate_invoice or args.send_invoice or args.debug:
+        _tmp_memory_file = memory_file_invoice
+        if memory_file_invoice and args.generate_invoice:
+            _tmp_memory_file = MemoryFile(filename=f"{args.generate_invoice}/{memory_file_invoice.filename}",
+                                          data=memory_file_invoice.data)
+        show_email(msg=msg_invoice, union=union,
+                   subject=union.invoice_subject, cc_emails=[union.cc_email, config.invoice_cc_email],
+                   attachments=[_tmp_memory_file], file=out)
+
+    if args.send_invoice:
+        settle_date = datetime.strptime(event.settle_date, "%d.%m.%Y").date()
+        if settle_date + timedelta(days=config.send_invoice_mail_days_after_event) <= date.today():
+            date_there_last_status_mail_is_sent = settle_date + timedelta(
+                days=config.send_last_status_mail_days_after_event)
+
+            if union.ticket_type_names and date_there_last_status_mail_is_sent > date.today():
+                print(f'============(The invoice email cannot be sent to {union.name}, '
+                      f'because the last ticket status email is not sent yet. '
+                      f'The invoice can be sent on the {date_there_last_status_mail_is_sent} or '
+                      f'after that date)============', file=out)
 
             else:
-                date_there_invoices_can_be_sent = settle_date + timedelta(
-                    days=CONFIG.send_invoice_mail_days_after_event)
-                print(f'============(The invoice email was not sent to {union.name}, '
-                      f'because it is not the {date_there_invoices_can_be_sent} or after that date)============')
+                if sent_state.is_sent("invoice", union.name):
+                    print(f'============(The invoice email was already sent to {union.name})============', file=out)
+                elif outbox.is_queued(sent_state, "invoice", union.name):
+                    print(f'============(The invoice email to {union.name} is already in the outbox)============',
+                          file=out)
+                else:
+                    send_email(
+                        msg=msg_invoice,
+                        union=union,
+                        cc_emails=[
+                            union.cc_email,
+                            config.invoice_cc_email
+                        ],
+                        bcc_emails=[
+                            union.from_email
+                        ],
+                        attachments=[memory_file_invoice],
+                        config=config,
+                        overwrite_email_receiver=args.overwrite_email_receiver,
+                        outbox=outbox,
+                        sent_state=sent_state,
+                        sent_kind="invoice",
+                    )
+                    print(f'============(The invoice email was already sent to {union.name})============', file=out)
+
+        else:
+            date_there_invoices_can_be_sent = settle_date + timedelta(
+                days=config.send_invoice_mail_days_after_event)
+            print(f'============(The invoice email was not sent to {union.name}, '
+                  f'because it is not the {date_there_invoices_can_be_sent} or after that date)============', file=out)
+
+
+class TestImport(unittest.TestCase):
+    def test_10_lazy_modules(self):
+        import os
+        import subprocess
+
+        # A new python process, because the modules may already be imported by the other tests
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [str(Path(__file__).resolve().parent.parent),
+                                                                        os.environ.get("PYTHONPATH")]))}
+        result = subprocess.run([sys.executable, "-c", "import sys, safeticket_mailer; print(*sys.modules)"],
+                                env=env, capture_output=True, text=True, check=True)
+        imported_modules = set(result.stdout.split())
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, imported_modules, f"{module} is imported when safeticket_mailer is imported")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
+import os
+import tempfile
+import threading
+import unittest
+from hashlib import sha256
+from pathlib import Path
+from typing import Optional
+
+
+class ArtifactCache:
+    """
+    The spreadsheets and invoices from the earlier runs, stored in the data folder.
+
+    Each artifact is stored in a file named after the hash of everything it is made from (the key),
+    so an artifact is reused when nothing it is made from have changed, and a change creates a new key
+    instead of updating the old artifact. The least recently used artifacts are removed, when the size
+    of the cache is over the max size.
+    """
+    folder: Path
+    max_size: int
+
+    def __init__(self, folder: Path, max_size: int):
+        """
+        :param folder: The folder of the cache, it is created if it doesn't exist
+        :param max_size: The max size of all the artifacts in bytes
+        """
+        self.folder = Path(folder)
+        self.folder.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        """Return: The key for an artifact made from the parts, the parts have to be in the same order each time"""
+        digest = sha256()
+        for part in parts:
+            encoded = part.encode()
+            # The length is included, so the parts can't be shifted into each other
+            digest.update(len(encoded).to_bytes(8, "big"))
+            digest.update(encoded)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.folder.joinpath(f"{key}.bin")
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            path = self._path(key)
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                return None
+
+            # The modification time is used as the last time the artifact was used
+            os.utime(path)
+            return data
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            path = self._path(key)
+            # Each writer have its own temporary file, because more processes can write the same key at the same
+            # time (like a run from the timer and the daemon), and the `.bin` file must only be replaced whole
+            tmp_file = tempfile.NamedTemporaryFile(dir=self.folder, prefix=f".{key}.", suffix=".tmp", delete=False)
+            try:
+                with tmp_file:
+                    tmp_file.write(data)
+                os.replace(tmp_file.name, path)
+            except BaseException:
+                Path(tmp_file.name).unlink(missing_ok=True)
+                raise
+
+            self._evict()
+
+    def _evict(self):
+        artifacts = []
+        for path in self.folder.glob("*.bin"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            artifacts.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in artifacts)
+        for _, size, path in sorted(artifacts):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+
+
+class TestArtifactCache(unittest.TestCase):
+    def test_10_concurrent_writers(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        key = ArtifactCache.key("spreadsheet", "Union1")
+        # Like more processes, each cache have its own lock
+        caches = [ArtifactCache(Path(folder.name), max_size=1024 * 1024 * 1024) for _ in range(4)]
+        artifacts = [bytes([index]) * 1024 * 1024 for index in range(len(caches))]
+
+        for _ in range(5):
+            with ThreadPoolExecutor(max_workers=len(caches)) as executor:
+                list(executor.map(ArtifactCache.put, caches, [key] * len(caches), artifacts))
+            self.assertIn(caches[0].get(key), artifacts)
+
+        self.assertEqual([path.name for path in Path(folder.name).iterdir()], [f"{key}.bin"])
+
+
+if __name__ == '__main__':
+    unittest.main()
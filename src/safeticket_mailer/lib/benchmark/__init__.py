@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+# ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
+import argparse
+import json
+import os
+import random
+import secrets
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from ..metrics import SUMMARY_NAME
+
+# The folder there contains the safeticket_mailer package
+PACKAGE_PARENT_PATH = Path(__file__).resolve().parents[3]
+EVENT_ID = 1
+EVENT_NAME = "Benchmark Event"
+# The fields of the CSV export from SafeTicket
+EXPORT_FIELDS = ["Billetnummer", "Ordre", "Tidspunkt", "Arrangement", "Billettype", "Pris", "Status",
+                 "Betalingstype", "Navn", "Email", "Addresse", "Addresse2", "Union Medlems ID", "Ankommet",
+                 "Ankomst", "Sektion"]
+# The number of rows there is made and sent at a time
+EXPORT_BATCH_SIZE = 5000
+# The baseline there is used when no `--baseline` is given, it is made with `--save-baseline`
+DEFAULT_BASELINE_PATH = Path(__file__).resolve().parent / "baseline.json"
+
+
+class SyntheticEvent:
+    """
+    An event with the tickets made from a seed, so each run gets the same tickets. The tickets are made while the
+    export is sent, so the server never have all of them in memory.
+    """
+    tickets: int
+    unions: int
+    ticket_type_names: List[str]
+
+    def __init__(self, tickets: int, ticket_types: int = 20, unions: int = 5, seed: int = 1):
+        """
+        :param ticket_types: The number of ticket types, some of them are for each union (with a discount in the name)
+        :param unions: The number of unions, each union gets at least one ticket type
+        """
+        self.tickets = tickets
+        self.unions = unions
+        self._seed = seed
+        self.ticket_type_names = [
+            f"Union{i % unions + 1} billet {i + 1} {(25, 50)[i % 2]}%" if i < max(unions, ticket_types // 2)
+            else f"Normal billet {i + 1}"
+            for i in range(max(ticket_types, unions))
+        ]
+
+    def union_ticket_type_names(self, union_index: int) -> List[str]:
+        return [name for name in self.ticket_type_names if name.startswith(f"Union{union_index + 1} ")]
+
+    def export_chunks(self) -> Iterator[bytes]:
+        """Return: The CSV export in chunks of bytes, in the same format as SafeTicket"""
+        rnd = random.Random(self._seed)
+        yield (";".join(f'"{field}"' for field in EXPORT_FIELDS) + "\r\n").encode("utf-8")
+
+        start_time = datetime(2024, 1, 1)
+        for batch_start in range(0, self.tickets, EXPORT_BATCH_SIZE):
+            lines = []
+            for i in range(batch_start, min(batch_start + EXPORT_BATCH_SIZE, self.tickets)):
+                ticket_type_name = rnd.choice(self.ticket_type_names)
+                row = [
+                    str(100000 + i), str(10000 + i // 3),
+                    (start_time + timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M:%S"),
+                    EVENT_NAME, ticket_type_name, f"{rnd.randrange(100, 2000)},{rnd.choice(('00', '50'))}",
+                    "Betalt", rnd.choice(("Kort", "MobilePay")), f"Deltager Æøå {i}", f"deltager{i}@example.com",
+                    f"Vej {rnd.randrange(1, 200)}", "", str(rnd.randrange(1000, 99999)), "", "", "",
+                ]
+                lines.append(";".join(f'"{value}"' for value in row) + "\r\n")
+            yield "".join(lines).encode("utf-8")
+
+
+class FakeSafeTicketHandler(BaseHTTPRequestHandler):
+    """Imitates the parts of SafeTicket there is used by the mailer, the login is checked with a cookie"""
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are written separately, so without it each small response waits for a delayed ACK
+    disable_nagle_algorithm = True
+    server: "FakeSafeTicketServer"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body: bytes, content_type: str = "application/json", status: int = 200,
+              headers: Dict[str, str] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data: Dict[str, Any]):
+        self._send(json.dumps(data).encode("utf-8"))
+
+    def _read_body(self) -> Dict[str, List[str]]:
+        # requests sends the data of a GET in the body, it have to be read, so the connection can be reused
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        return parse_qs(body.decode("utf-8"))
+
+    def _is_logged_in(self) -> bool:
+        return f"sid={self.server.session_id}" in self.headers.get("Cookie", "")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self._read_body()
+        event = self.server.event
+
+        if url.path == "/admin/":
+            if self._is_logged_in():
+                self._send(b"<html></html>", "text/html")
+            else:
+                self._send(b"", "text/html", 302, {"Location": "/admin/login"})
+        elif not self._is_logged_in():
+            self._send(b"{}", status=403)
+        elif url.path == "/admin/api/event":
+            past = parse_qs(url.query).get("past") == ["1"]
+            settle_date = date.today() + timedelta(days=30)
+            events = [] if past else [{
+                "created_email": "benchmark@example.com", "created_name": "Benchmark", "eventts": 1735689600,
+                "id": EVENT_ID, "name": EVENT_NAME, "settledate": settle_date.strftime("%d.%m.%Y"), "settled": 0,
+                "tickets_on_offer": event.tickets, "tickets_remaining": 0, "tickets_sold": str(event.tickets),
+                "turnover_today": "0", "turnover_total": str(event.tickets * 100), "user_permissions": {},
+            }]
+            self._send_json({"status": "OK", "data": {
+                "events": events, "has_unsettled_events_without_valid_bankaccount": 0, "settled_events": 0,
+                "sold": event.tickets, "today": "0", "total": str(event.tickets * 100)}})
+        elif url.path == "/admin/api/financial":
+            self._send_json({"status": "OK", "data": {"name": EVENT_NAME, "tickets": [
+                {"id": ticket_id, "name": name} for ticket_id, name in enumerate(event.ticket_type_names, start=1)]}})
+        else:
+            self._send(b"Not found", "text/html", 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self._read_body()
+
+        if url.path == "/admin/login":
+            self._send(b"", "text/html", 302, {"Location": "/admin/",
+                                               "Set-Cookie": f"sid={self.server.session_id}; Path=/"})
+        elif not self._is_logged_in():
+            self._send(b"", "text/html", 403)
+        elif url.path == "/admin/eventexportcsv":
+            # The size of the export is not known before it is made, so it is sent in chunks
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv; charset=utf-8")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in self.server.event.export_chunks():
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self._send(b"Not found", "text/html", 404)
+
+
+class FakeSafeTicketServer(ThreadingHTTPServer):
+    daemon_threads = True
+    event: SyntheticEvent
+    session_id: str
+
+    def __init__(self, event: SyntheticEvent):
+        super().__init__(("127.0.0.1", 0), FakeSafeTicketHandler)
+        self.event = event
+        self.session_id = secrets.token_hex(16)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+    """Accepts any login and any email, the emails are only counted"""
+    disable_nagle_algorithm = True
+    server: "SmtpSink"
+
+    def _reply(self, line: str):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self._reply("220 localhost SMTP sink")
+        for line in self.rfile:
+            command = line.decode("ascii", errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self._reply("250-localhost")
+                self._reply("250-AUTH PLAIN LOGIN")
+                self._reply("250 8BITMIME")
+            elif verb == "AUTH":
+                self._reply("235 Authentication successful")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                self.server.received(size)
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                # HELO, MAIL, RCPT, RSET and NOOP
+                self._reply("250 OK")
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    messages: int
+    message_bytes: int
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SmtpSinkHandler)
+        self.messages = 0
+        self.message_bytes = 0
+        self._lock = threading.Lock()
+
+    def received(self, size: int):
+        with self._lock:
+            self.messages += 1
+            self.message_bytes += size
+
+
+def write_config(path: Path, event: SyntheticEvent, safeticket_url: str, smtp_port: int):
+    """Write a config file for the mailer, there uses the local servers and has a union for each union of the event"""
+    unions = "\n".join(
+        f"        Union(name='Union{i + 1}', subject='Status', to_name='Union {i + 1}',\n"
+        f"              to_email='Union {i + 1} <union{i + 1}@example.com>', from_name='Benchmark',\n"
+        f"              from_email='Benchmark <benchmark@example.com>',\n"
+        f"              ticket_type_names={event.union_ticket_type_names(i)!r},\n"
+        f"              ticket_fields_extra=['Union Medlems ID'], invoice_subject='Invoice',\n"
+        f"              invoice_address='Vej 1', invoice_zip_code='1000', invoice_city='By'),"
+        for i in range(event.unions))
+
+    path.write_text(f"""from safeticket_mailer.lib.config.config_example import Config as ExampleConfig, Union
+
+
+class Config(ExampleConfig):
+    organization = 'benchmark'
+    username = 'benchmark@example.com'
+    password = 'benchmark'
+    safeticket_url = {safeticket_url!r}
+
+    class SMTP:
+        host = '127.0.0.1'
+        port = {smtp_port}
+        username = 'benchmark'
+        password = 'benchmark'
+        use_ssl = False
+
+    event_name = {EVENT_NAME!r}
+    ticket_fields = ['Navn', 'Email', 'Ordre', 'Tidspunkt']
+    unions = [
+{unions}
+    ]
+""")
+
+
+class BenchmarkResult(NamedTuple):
+    tickets: int
+    wall_time: float
+    peak_rss_mb: float
+    phases: Dict[str, float]
+    emails: int
+
+
+def run_mailer(config_path: Path, data_folder: Path, args: List[str]) -> Tuple[float, float]:
+    """
+    Run the mailer in a new process, so its memory usage is measured alone
+    Return: The wall time in seconds and the peak RSS in MB
+    """
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(PACKAGE_PARENT_PATH), os.environ.get("PYTHONPATH")])),
+        # The example config reads the logins from the environment
+        "SAFETICKET_USERNAME": "benchmark", "SAFETICKET_PASSWORD": "benchmark", "SMTP_PASSWORD": "benchmark",
+    }
+    command = [sys.executable, "-c", "from safeticket_mailer import main; main()",
+               "--config-file", str(config_path), "--data-folder", str(data_folder), *args]
+
+    start_time = perf_counter()
+    # The `with` closes the stderr pipe, and it doesn't wait again, because the return code is set
+    with subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) as process:
+        stderr = process.stderr.read()
+        # `wait4` returns the resource usage of the process, `ru_maxrss` is in kB on Linux
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_time = perf_counter() - start_time
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        raise RuntimeError(f"The mailer failed with the exit code {process.returncode}:\n"
+                           f"{stderr.decode(errors='replace')}")
+    return wall_time, usage.ru_maxrss / 1024
+
+
+def run_benchmark(event: SyntheticEvent, jobs: int = 1) -> BenchmarkResult:
+    """Run the mailer once against the local servers with a new data folder, and send the status emails"""
+    safeticket_server = FakeSafeTicketServer(event)
+    smtp_sink = SmtpSink()
+    for server in (safeticket_server, smtp_sink):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="safeticket-mailer-benchmark-") as folder:
+            config_path = Path(folder).joinpath("config.py")
+            data_folder = Path(folder).joinpath("data")
+            write_config(config_path, event, safeticket_url=safeticket_server.url,
+                         smtp_port=smtp_sink.server_address[1])
+
+            wall_time, peak_rss_mb = run_mailer(config_path, data_folder,
+                                                ["--send-emails", "--no-artifact-cache", "--jobs", str(jobs)])
+
+            summary = json.loads(data_folder.joinpath(SUMMARY_NAME).read_text())
+            phases: Dict[str, float] = {}
+            for phase in summary["phases"]:
+                phases[phase["phase"]] = phases.get(phase["phase"], 0.0) + phase["seconds"]
+
+        return BenchmarkResult(tickets=event.tickets, wall_time=wall_time, peak_rss_mb=peak_rss_mb, phases=phases,
+                               emails=smtp_sink.messages)
+    finally:
+        for server in (safeticket_server, smtp_sink):
+            server.shutdown()
+            server.server_close()
+
+
+def find_regressions(result: BenchmarkResult, baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Return: A description of each measurement there is worse than the baseline plus the tolerance"""
+    regressions = []
+    for name, value in (("wall_time", result.wall_time), ("peak_rss_mb", result.peak_rss_mb)):
+        limit = baseline[name] * (1 + tolerance)
+        if value > limit:
+            regressions.append(f"{result.tickets} tickets: {name} is {value:.2f}, "
+                               f"the baseline is {baseline[name]:.2f} (limit {limit:.2f})")
+    return regressions
+
+
+def print_result(result: BenchmarkResult, baseline: Optional[Dict[str, Any]]):
+    def change(name: str, value: float) -> str:
+        if baseline is None or not baseline.get(name):
+            return ""
+        return f" ({(value / baseline[name] - 1) * 100:+.1f} %)"
+
+    print(f"============({result.tickets} tickets)============")
+    print(f"wall time    {result.wall_time:9.3f} s{change('wall_time', result.wall_time)}")
+    print(f"peak RSS     {result.peak_rss_mb:9.1f} MB{change('peak_rss_mb', result.peak_rss_mb)}")
+    print(f"emails sent  {result.emails:9d}")
+    for phase, seconds in sorted(result.phases.items(), key=lambda item: -item[1]):
+        print(f"  {phase:<18} {seconds:9.3f} s")
+
+
+def main():
+    """
+    Run the benchmark for each number of tickets. With `--save-baseline` the results are stored in the baseline
+    file, otherwise the run fails if a result is slower or uses more memory than the baseline plus the tolerance
+    """
+    parser = argparse.ArgumentParser(description="Benchmark of the SafeTicket mailer against local servers")
+    # A run of a few thousand tickets is mostly the start of python, so it is too noisy to compare by default
+    parser.add_argument("--tickets", type=int, nargs="+", default=[10_000, 100_000],
+                        help="The number of tickets in the event, a benchmark is run for each of them "
+                             "(like 1000 10000 100000 1000000)")
+    parser.add_argument("--ticket-types", type=int, default=20, help="The number of ticket types in the event")
+    parser.add_argument("--unions", type=int, default=5, help="The number of unions in the config")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="The --jobs argument of the mailer")
+    parser.add_argument("--repeat", type=int, default=3, help="Run each benchmark more times and use the fastest")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE_PATH,
+                        help="The JSON file with the results to compare with (default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true", default=False,
+                        help="Store the results in the baseline file, instead of comparing with it")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="How much worse than the baseline a result can be before it fails, 0.2 is 20 %%")
+    args = parser.parse_args()
+
+    # The results depend on more than the number of tickets, so a baseline is only used with the same arguments
+    settings = {"ticket_types": args.ticket_types, "unions": args.unions, "jobs": args.jobs}
+
+    baselines = {}
+    if args.baseline.is_file() and not args.save_baseline:
+        baselines = json.loads(args.baseline.read_text())
+
+    results = []
+    regressions = []
+    for tickets in args.tickets:
+        event = SyntheticEvent(tickets=tickets, ticket_types=args.ticket_types, unions=args.unions)
+        result = min((run_benchmark(event, jobs=args.jobs) for _ in range(max(args.repeat, 1))),
+                     key=lambda run: run.wall_time)
+        results.append(result)
+
+        baseline = baselines.get(str(tickets))
+        if baseline is not None and baseline.get("settings", settings) != settings:
+            print(f"WARNING: The baseline of {tickets} tickets is made with {baseline['settings']}, "
+                  f"so it is not compared", file=sys.stderr)
+            baseline = None
+        print_result(result, baseline)
+        if baseline is not None:
+            regressions += find_regressions(result, baseline, args.tolerance)
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(
+            {str(result.tickets): {"wall_time": result.wall_time, "peak_rss_mb": result.peak_rss_mb,
+                                   "phases": result.phases, "settings": settings} for result in results},
+            indent=4) + "\n")
+        print(f"============(Saved the baseline: {args.baseline})============")
+
+    if regressions:
+        print("============(The benchmark is worse than the baseline)============")
+        for regression in regressions:
+            print(regression)
+        sys.exit(1)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_10_export(self):
+        event = SyntheticEvent(tickets=12_000, ticket_types=6, unions=2)
+        lines = b"".join(event.export_chunks()).decode("utf-8").splitlines()
+        self.assertEqual(len(lines), 12_001)
+        self.assertEqual(b"".join(event.export_chunks()), b"".join(event.export_chunks()))
+        self.assertEqual(len(event.union_ticket_type_names(0)), 2)
+
+    def test_20_end_to_end(self):
+        result = run_benchmark(SyntheticEvent(tickets=1000, ticket_types=6, unions=2))
+        self.assertEqual(result.emails, 2)
+        self.assertIn("export_parse", result.phases)
+        self.assertFalse(find_regressions(result, {"wall_time": result.wall_time,
+                                                   "peak_rss_mb": result.peak_rss_mb}, tolerance=0.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+#!/usr/bin/env python3
+# ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
+from . import main
+
+main()
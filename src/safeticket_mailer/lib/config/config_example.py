@@ -77,13 +77,24 @@ class Config:
     organization = 'example'  # EXAMPLE.safeticket.dk
     username = environ["SAFETICKET_USERNAME"]  # Normally, this is an email address
     password = environ["SAFETICKET_PASSWORD"]
+    # The encoding of the CSV export and the API responses, it is only used if SafeTicket doesn't
+    # tell the encoding in the Content-Type header or with a BOM (byte order mark)
+    safeticket_encoding = 'utf-8'
+    # Another address of SafeTicket than https://EXAMPLE.safeticket.dk, like a local server for the benchmark
+    # safeticket_url = 'http://127.0.0.1:8080'
 
-    # SMTP (mail) server config (currently, only SSL is supported)
+    # SMTP (mail) server config
     class SMTP:
         host = 'example.com'
         port = 587  # '25, 465, 587'
         username = environ["SMTP_PASSWORD"]
         password = environ["SMTP_PASSWORD"]
+        # Without SSL, STARTTLS is used if the server supports it
+        use_ssl = True
+
+    # When the reports are made with the --daemon argument, as a cron expression:
+    # minute hour day-of-month month day-of-week (The --schedule argument overrides it)
+    schedule = "0 7 * * 1"  # Every Monday at 07:00
 
     # This variable tells the SafeTicket mailer to send the last status mail X amount of
     # days after the event, this is based on the 'settledate' information.
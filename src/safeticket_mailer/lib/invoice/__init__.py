@@ -1,26 +1,177 @@
 import html
+import io
 import os
+import re
 import shutil
 import sys
+import threading
+import unittest
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from subprocess import Popen, PIPE
-from typing import Optional, NamedTuple, Dict, List
+from typing import Optional, NamedTuple, Dict, List, TextIO, Tuple, Iterator
 import locale
 
-from jinja2 import Template, StrictUndefined
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, StrictUndefined
 
-CURRENT_DIR = Path(__file__).parent
-TWEMOJI_JS_FILE_PATH = CURRENT_DIR.joinpath("twemoji/twemoji.js")
-TEMPLATE_CONTENT = CURRENT_DIR.joinpath("template.html").read_text()
+from ..artifact_cache import ArtifactCache
+from ..pdf_renderer import PdfRenderer, PdfRenderError, BIN_HTML_TO_PDF
 
+CURRENT_DIR = Path(__file__).parent
+TWEMOJI_FOLDER_PATH = CURRENT_DIR.joinpath("twemoji/72x72")
+TEMPLATE_NAME = "template.html"
+
+
+@lru_cache(maxsize=None)
+def check_html_to_pdf():
+    """Check if wkhtmltopdf is installed, it is only checked the first time an invoice is made"""
+    if shutil.which(BIN_HTML_TO_PDF) is None:
+        print(f"The program `{BIN_HTML_TO_PDF}` localed in the paths from the environment variable PATH "
+              f"({os.environ.get('PATH')}). You can install `{BIN_HTML_TO_PDF}` with: "
+              f"pikaur -Sy --noconfirm wkhtmltopdf")
+        sys.exit(1)
+
+
+# The emojis there is shown as text, unless they are followed by the emoji variation selector
+TEXT_STYLE_EMOJIS = {"\u00a9", "\u00ae", "\u2122", "\u265f"}
+VARIATION_SELECTOR_EMOJI = "\ufe0f"
+VARIATION_SELECTOR_TEXT = "\ufe0e"
+ZERO_WIDTH_JOINER = "\u200d"
+
+
+@lru_cache(maxsize=None)
+def _twemoji_sequences() -> Tuple[Dict[str, Path], int, re.Pattern]:
+    """
+    Return: All the ways the emojis with an image can be written mapped to the image, the length
+    of the longest of them and a pattern there finds the first character of them. Like twemoji.js,
+    the variation selector (U+FE0F) is optional after each character, unless the emoji is joined
+    from more emojis with U+200D.
+    """
+    sequences: Dict[str, Path] = {}
+    for path in TWEMOJI_FOLDER_PATH.glob("*.png"):
+        chars = [chr(int(code_point, 16)) for code_point in path.stem.split("-")]
+
+        if ZERO_WIDTH_JOINER in chars:
+            variants = ["".join(chars)]
+        elif len(chars) == 1 and chars[0] in TEXT_STYLE_EMOJIS:
+            variants = [chars[0] + VARIATION_SELECTOR_EMOJI]
+        else:
+            variants = [""]
+            for char in chars:
+                variants = [variant + char + selector
+                            for variant in variants for selector in ("", VARIATION_SELECTOR_EMOJI)]
+
+        for variant in variants:
+            sequences[variant] = path
+
+    first_chars = sorted({sequence[0] for sequence in sequences})
+    return sequences, max(map(len, sequences)), re.compile("[{}]".format("".join(map(re.escape, first_chars))))
+
+
+def _twemoji_text(text: str) -> str:
+    sequences, max_length, first_char_pattern = _twemoji_sequences()
+
+    result = []
+    start = 0
+    for match in first_char_pattern.finditer(text):
+        i = match.start()
+        if i < start:
+            # It is a part of the last emoji
+            continue
+
+        # The longest emoji first, so an emoji is not replaced by the emojis it is joined from
+        for length in range(min(max_length, len(text) - i), 0, -1):
+            emoji = text[i:i + length]
+            path = sequences.get(emoji)
+            if path is not None and not text.startswith(VARIATION_SELECTOR_TEXT, i + length):
+                result.append(text[start:i])
+                result.append(f'<img class="emoji" draggable="false" alt="{emoji}" src="{path.as_uri()}"/>')
+                start = i + length
+                break
+
+    result.append(text[start:])
+    return "".join(result)
+
+
+def twemoji(html_text: str) -> str:
+    """
+    A Jinja filter there replaces the emojis with `<img>` tags of the bundled twemoji images,
+    like `twemoji.parse()` did in the browser. Only the text between the HTML tags is changed.
+    """
+    return "".join(part if part.startswith("<") else _twemoji_text(part)
+                   for part in re.split(r"(<[^>]*>)", html_text))
+
+
+# The template is compiled once per process, and the environment is safe to use from more threads
+ENVIRONMENT = Environment(loader=FileSystemLoader(CURRENT_DIR), undefined=StrictUndefined)
+ENVIRONMENT.filters["twemoji"] = twemoji
+
+
+def set_template_cache_folder(folder: Path):
+    """Store the compiled template in the folder, so it is only compiled again when the template is changed"""
+    folder.mkdir(mode=0o700, parents=True, exist_ok=True)
+    ENVIRONMENT.bytecode_cache = FileSystemBytecodeCache(directory=str(folder))
+
+
+def _grouping_intervals(grouping: Tuple[int, ...]) -> Iterator[int]:
+    """The sizes of the groups of digits from the right, the same way as in the `locale` module"""
+    last = None
+    for size in grouping:
+        if size == locale.CHAR_MAX:
+            return
+        if size == 0:
+            while last:
+                yield last
+            return
+        yield size
+        last = size
+
+
+class CurrencyFormatter(NamedTuple):
+    """Formats an amount the same way as `locale.format_string('%.2f', amount, grouping=True)`"""
+    decimal_point: str
+    thousands_sep: str
+    grouping: Tuple[int, ...]
+
+    @classmethod
+    def from_locale(cls) -> "CurrencyFormatter":
+        """Read the number format of the locale from the environment (like `LANG`)"""
+        with _locale_lock:
+            previous = locale.setlocale(locale.LC_NUMERIC)
+            try:
+                locale.setlocale(locale.LC_NUMERIC, locale.getlocale())
+                conventions = locale.localeconv()
+            except locale.Error:
+                conventions = locale.localeconv()
+            finally:
+                locale.setlocale(locale.LC_NUMERIC, previous)
+
+        return cls(decimal_point=conventions["decimal_point"], thousands_sep=conventions["thousands_sep"],
+                   grouping=tuple(conventions["grouping"]))
+
+    def format(self, amount: float) -> str:
+        sign, digits = ("-", f"{-amount:.2f}") if amount < 0 else ("", f"{amount:.2f}")
+        integer, decimals = digits.split(".")
+
+        groups = []
+        if self.thousands_sep:
+            for size in _grouping_intervals(self.grouping):
+                if len(integer) <= size:
+                    break
+                groups.append(integer[-size:])
+                integer = integer[:-size]
+        groups.append(integer)
+
+        return sign + self.thousands_sep.join(reversed(groups)) + self.decimal_point + decimals
 
-# Check if wkhtmltopdf is installed
-BIN_HTML_TO_PDF = "wkhtmltopdf"
-if shutil.which(BIN_HTML_TO_PDF) is None:
-    print(f"The program `{BIN_HTML_TO_PDF}` localed in the paths from the environment variable PATH "
-          f"({os.environ.get('PATH')}). You can install `{BIN_HTML_TO_PDF}` with: pikaur -Sy --noconfirm wkhtmltopdf")
-    sys.exit(1)
+
+_locale_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_currency_formatter() -> CurrencyFormatter:
+    """The number format of the locale is only read once, instead of changing the locale for each invoice"""
+    return CurrencyFormatter.from_locale()
 
 
 class TicketInfo(NamedTuple):
@@ -36,8 +187,6 @@ class Order(NamedTuple):
 
 
 class Invoice:
-    _template: TEMPLATE_CONTENT
-
     title: str
     invoice_no: int
     invoice_no_prefix: str
@@ -63,11 +212,6 @@ class Invoice:
                  from_address: str, from_zip_code: str, from_city: str,
                  receiver_name: str, receiver_cvr_no: Optional[str], to_address: str, to_zip_code: str, to_city: str,
                  registration_no: int, account_no: int):
-        self._template = Template(
-            source=TEMPLATE_CONTENT,
-        )
-        self._template.environment.undefined = StrictUndefined
-
         self.title = title
         self.invoice_no = invoice_no
         self.invoice_no_prefix = invoice_no_prefix
@@ -89,16 +233,27 @@ class Invoice:
         self.registration_no = registration_no
         self.account_no = account_no
 
-    def generate_html(self, pdf_output_file: Path,
-                      currency: str, additional_sponsorship: Optional[float], tickets: Dict[str, TicketInfo]):
+    def generate_html(self, pdf_output_file: Optional[Path],
+                      currency: str, additional_sponsorship: Optional[float], tickets: Dict[str, TicketInfo],
+                      renderer: PdfRenderer, file: Optional[TextIO] = None,
+                      artifact_cache: Optional[ArtifactCache] = None) -> Optional[bytes]:
+        """
+        :param pdf_output_file: Where to save the PDF and the HTML it is made from. The invoice is only
+        created in memory, if it is `None`
+        :param renderer: The pool of `wkhtmltopdf` workers there renders the PDF
+        :param artifact_cache: Reuse the PDF from the cache, if the HTML of the invoice haven't changed.
+        Everything on the invoice is in the HTML (the template, the tickets, the amounts...), except the date
+        Return: The PDF, or None if there is nothing to invoice
+        """
+        file = file if file else sys.stdout
         dt = datetime.now()
-        locale.setlocale(category=locale.LC_ALL, locale=locale.getlocale())
+        currency_formatter = get_currency_formatter()
 
         total_sum = 0.0
 
         if additional_sponsorship:
             total_sum += additional_sponsorship
-            additional_sponsorship = locale.format_string('%.2f', float(additional_sponsorship), grouping=True)
+            additional_sponsorship = currency_formatter.format(float(additional_sponsorship))
         else:
             additional_sponsorship = None
 
@@ -111,19 +266,11 @@ class Invoice:
             orders.append(Order(
                 count=info.sold_tickets,
                 name=ticket_name,
-                price_formatted=locale.format_string('%.2f', sum_of_tickets, grouping=True),
+                price_formatted=currency_formatter.format(sum_of_tickets),
             ))
 
-        pdf_output_file.parent.mkdir(mode=0o700, exist_ok=True)
-        twemoji_js_file_path = pdf_output_file.parent.joinpath("twemoji.js")
-        twemoji_js_content = TWEMOJI_JS_FILE_PATH.read_text().replace(
-            "%%%TWEMOJI_JS_CONTENT%%%", TWEMOJI_JS_FILE_PATH.parent.__str__())
-        twemoji_js_file_path.write_text(twemoji_js_content)
-
-        html_text = self._template.render(
-            date=dt.date().__str__(),
-            twemoji_js_file_path=twemoji_js_file_path,
-
+        template = ENVIRONMENT.get_template(TEMPLATE_NAME)
+        context = dict(
             title=f"Faktura: {self.title}",
             invoice_no='{}{}{}'.format(self.invoice_no_prefix, dt.year, self.invoice_no),
             sender_name=self.sender_name,
@@ -146,29 +293,111 @@ class Invoice:
             currency=currency,
             additional_sponsorship=additional_sponsorship,
             orders=orders,
-            total_sum=locale.format_string('%.2f', total_sum, grouping=True),
+            total_sum=currency_formatter.format(total_sum),
         )
+        html_text = template.render(date=dt.date().__str__(), **context)
 
-        with open(pdf_output_file.parent.joinpath(f"{pdf_output_file.stem}.html"), "w") as f:
-            f.write(html_text)
-
-        if pdf_output_file.parent.exists() and os.access(pdf_output_file.parent, os.W_OK):
-            pid = Popen(['wkhtmltopdf', '--enable-local-file-access', '--encoding', 'UTF-8', '--title', self.title,
-                         '-', pdf_output_file.__str__()],
-                        stdin=PIPE, stderr=PIPE, stdout=PIPE)
-            stdout, stderr = pid.communicate(input=html_text.encode())
-            exit_code = pid.wait()
-
-            if exit_code == 0:
-                print(f"============(Created the pdf: {pdf_output_file})============")
-            else:
-                print(f"Failed at creating the pdf: {pdf_output_file}")
-                print(f"STDOUT:\n{stdout}\n")
-                print(f"STDERR:\n{stderr}")
+        if pdf_output_file is not None:
+            pdf_output_file.parent.mkdir(mode=0o700, exist_ok=True)
+            if not os.access(pdf_output_file.parent, os.W_OK):
+                print(f"The folder there you want to safe the generated invoices doesn't exist or"
+                      f" you don't have write access: {pdf_output_file.parent}", file=file)
                 exit(1)
-        else:
-            print(f"The folder there you want to safe the generated invoices doesn't exist or"
-                  f" you don't have write access: {pdf_output_file.parent}")
-            exit(1)
 
-        return bool(total_sum)
+            with open(pdf_output_file.parent.joinpath(f"{pdf_output_file.stem}.html"), "w") as f:
+                f.write(html_text)
+
+        # The emojis are already images, so there is no JavaScript to run or wait for
+        options = ('--enable-local-file-access', '--disable-javascript', '--javascript-delay', '0',
+                   '--encoding', 'UTF-8', '--title', self.title)
+
+        pdf = None
+        artifact_key = None
+        if artifact_cache is not None:
+            # The date changes every day, so it is left out of the key, otherwise the PDF would never be reused
+            # between the weekly runs. The PDF from the cache have the date from the day it was rendered
+            artifact_key = ArtifactCache.key("invoice", template.render(date="", **context), repr(options))
+            pdf = artifact_cache.get(artifact_key)
+
+        if pdf is None:
+            check_html_to_pdf()
+            try:
+                # The HTML is piped into wkhtmltopdf and the PDF is read from stdout
+                pdf = renderer.render(html_text, options=options)
+            except PdfRenderError as e:
+                print(f"Failed at creating the pdf for {self.receiver_name}", file=file)
+                print(f"STDOUT:\n{e.stdout}\n", file=file)
+                print(f"STDERR:\n{e.stderr}", file=file)
+                exit(1)
+
+            if artifact_cache is not None:
+                artifact_cache.put(artifact_key, pdf)
+
+        if pdf_output_file is not None:
+            pdf_output_file.write_bytes(pdf)
+            print(f"============(Created the pdf: {pdf_output_file})============", file=file)
+        else:
+            print(f"============(Created the pdf for {self.receiver_name})============", file=file)
+
+        return pdf if total_sum else None
+
+
+class TestInvoice(unittest.TestCase):
+    def test_10_twemoji(self):
+        def image(name: str, emoji: str) -> str:
+            path = TWEMOJI_FOLDER_PATH.joinpath(f"{name}.png")
+            return f'<img class="emoji" draggable="false" alt="{emoji}" src="{path.as_uri()}"/>'
+
+        grinning = "\U0001f600"
+        self.assertEqual(twemoji(f'<p title="{grinning}">Hej {grinning}</p>'),
+                         f'<p title="{grinning}">Hej {image("1f600", grinning)}</p>')
+        # The text style emojis are only replaced when they are followed by the emoji variation selector
+        copyright_sign = "\u00a9"
+        self.assertEqual(twemoji(f"{copyright_sign} {copyright_sign}{VARIATION_SELECTOR_EMOJI}"),
+                         f"{copyright_sign} {image('a9', copyright_sign + VARIATION_SELECTOR_EMOJI)}")
+        self.assertEqual(twemoji("\u2764" + VARIATION_SELECTOR_TEXT), "\u2764" + VARIATION_SELECTOR_TEXT)
+        family = ZERO_WIDTH_JOINER.join(["\U0001f468", "\U0001f469", "\U0001f467"])
+        self.assertEqual(twemoji(family), image("1f468-200d-1f469-200d-1f467", family))
+
+    def test_20_currency_formatter(self):
+        danish = CurrencyFormatter(decimal_point=",", thousands_sep=".", grouping=(3, 0))
+        self.assertEqual(danish.format(1234567.5), "1.234.567,50")
+        self.assertEqual(danish.format(-1234.5), "-1.234,50")
+        self.assertEqual(danish.format(999), "999,00")
+        self.assertEqual(CurrencyFormatter(".", ",", (3, locale.CHAR_MAX)).format(1234567), "1234,567.00")
+        self.assertEqual(CurrencyFormatter(".", "", ()).format(1234567.125), "1234567.12")
+
+
+    def test_30_cached_on_another_day(self):
+        import tempfile
+        from unittest import mock
+
+        class Renderer:
+            pdfs = []
+
+            def render(self, html_text: str, options) -> bytes:
+                self.pdfs.append(html_text.encode())
+                return self.pdfs[-1]
+
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        artifact_cache = ArtifactCache(Path(folder.name), max_size=1024 * 1024)
+        invoice = Invoice("Event", 1, "E", "Sender", "12345678", "sender@example.com", "Vej 1", "1000", "By",
+                          "Union1", None, "Vej 2", "2000", "By", 1234, 5678)
+        tickets = {"Voksen 50%": TicketInfo(selling_price=100.0, discount_percent=50, sold_tickets=3)}
+
+        pdfs = []
+        # A week later, like the weekly runs
+        for now in (datetime(2024, 6, 1), datetime(2024, 6, 8), datetime(2024, 6, 8)):
+            with mock.patch(f"{__name__}.datetime") as mock_datetime, mock.patch(f"{__name__}.check_html_to_pdf"):
+                mock_datetime.now.return_value = now
+                pdfs.append(invoice.generate_html(None, "DKK", None, tickets, renderer=Renderer(),
+                                                  file=io.StringIO(), artifact_cache=artifact_cache))
+
+        self.assertEqual(len(Renderer.pdfs), 1)
+        self.assertEqual(pdfs, [Renderer.pdfs[0]] * 3)
+        self.assertIn(b"2024-06-01", pdfs[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
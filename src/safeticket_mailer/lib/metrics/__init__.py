@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
+import json
+import os
+import threading
+import unittest
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter, time
+from typing import Any, Dict, Iterator, List, Tuple
+
+METRIC_PREFIX = "safeticket_mailer"
+# The node_exporter textfile collector reads the `.prom` files in its folder
+TEXTFILE_NAME = "safeticket-mailer.prom"
+SUMMARY_NAME = "last-run.json"
+
+# The descriptions of the counters, a counter there isn't here is still exported
+COUNTER_HELP = {
+    "export_bytes": "The size of the CSV export from SafeTicket in bytes",
+    "export_rows": "The number of tickets in the CSV export from SafeTicket",
+    "safeticket_requests": "The number of requests to SafeTicket",
+    "safeticket_retries": "The number of requests to SafeTicket there was retried",
+    "safeticket_timeouts": "The number of requests to SafeTicket there timed out",
+    "safeticket_wait_seconds": "The time spent waiting for the responses from SafeTicket",
+    "spreadsheets_built": "The number of spreadsheets there was built",
+    "spreadsheets_cached": "The number of spreadsheets there was reused from the artifact cache",
+    "emails_sent": "The number of emails there was sent",
+}
+
+# A metric is identified by its name and its labels, like ("spreadsheet", (("union", "Union1"),))
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, Any]) -> Key:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(value) if isinstance(value, int) else repr(round(value, 6))
+
+
+def _write_atomic(path: Path, text: str):
+    """Write the file, so the textfile collector never reads a half written file"""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+
+class Metrics:
+    """
+    The timers and the counters of one run. A timer adds up the time spent in a phase of the run (like
+    `login` or `spreadsheet`), and both of them can have labels, like the name of the union.
+    It is used from the threads of the unions at the same time.
+    """
+    started_at: float
+    success: bool
+    timers: Dict[Key, List[float]]
+    counters: Dict[Key, float]
+
+    def __init__(self):
+        self.started_at = time()
+        self.success = False
+        self.timers = {}
+        self.counters = {}
+        self._start_time = perf_counter()
+        self._duration = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, phase: str, **labels) -> Iterator[None]:
+        start_time = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, perf_counter() - start_time, **labels)
+
+    def add_time(self, phase: str, seconds: float, **labels):
+        with self._lock:
+            timer = self.timers.setdefault(_key(phase, labels), [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @property
+    def duration(self) -> float:
+        """The number of seconds since the run started, or the duration of the run when it is finished"""
+        return self._duration if self._duration is not None else perf_counter() - self._start_time
+
+    def finish(self):
+        """Stop the clock of the run"""
+        self._duration = perf_counter() - self._start_time
+
+    def summary(self) -> Dict[str, Any]:
+        """Return: The run as JSON"""
+        with self._lock:
+            return {
+                "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+                "duration_seconds": round(self.duration, 6),
+                "success": self.success,
+                "phases": [{"phase": phase, **dict(labels), "count": count, "seconds": round(seconds, 6)}
+                           for (phase, labels), (count, seconds) in self.timers.items()],
+                "counters": [{"name": name, **dict(labels), "value": value}
+                             for (name, labels), value in self.counters.items()],
+            }
+
+    def textfile(self) -> str:
+        """Return: The run in the text format of Prometheus, for the node_exporter textfile collector"""
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: List[Tuple[Tuple, float]]):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}{_format_labels(labels)} {_format_value(value)}")
+
+        metric("last_run_timestamp_seconds", "gauge", "When the last run started, as a Unix timestamp",
+               [((), self.started_at)])
+        metric("last_run_duration_seconds", "gauge", "How long time the last run took",
+               [((), self.duration)])
+        metric("last_run_success", "gauge", "1 if the last run succeeded, otherwise 0",
+               [((), int(self.success))])
+
+        with self._lock:
+            timers = sorted(self.timers.items())
+            counters = sorted(self.counters.items())
+
+        metric("phase_seconds", "gauge", "The time spent in each phase of the last run",
+               [((("phase", phase),) + labels, seconds) for (phase, labels), (_, seconds) in timers])
+        metric("phase_count", "gauge", "How many times each phase was done in the last run",
+               [((("phase", phase),) + labels, count) for (phase, labels), (count, _) in timers])
+
+        for name in sorted({name for (name, _), _ in counters}):
+            metric(name, "gauge", COUNTER_HELP.get(name, f"The {name.replace('_', ' ')} in the last run"),
+                   [(labels, value) for (counter_name, labels), value in counters if counter_name == name])
+
+        return "\n".join(lines) + "\n"
+
+    def breakdown(self) -> str:
+        """Return: The phases and the counters as a table to read"""
+        with self._lock:
+            timers = list(self.timers.items())
+            counters = list(self.counters.items())
+
+        def label_text(name: str, labels: Tuple[Tuple[str, str], ...]) -> str:
+            return name + "".join(f" {value}" for _, value in labels)
+
+        rows = [(label_text(phase, labels), f"{seconds:.3f} s", f"{seconds / self.duration * 100:.1f} %",
+                 f"x{count}" if count > 1 else "")
+                for (phase, labels), (count, seconds) in timers]
+        rows += [(label_text(name, labels), _format_value(value), "", "") for (name, labels), value in counters]
+        rows.append(("total", f"{self.duration:.3f} s", "", ""))
+
+        widths = [max(len(row[column]) for row in rows) for column in range(4)]
+        return "\n".join(f"{name:<{widths[0]}}  {value:>{widths[1]}}  {share:>{widths[2]}}  {count}".rstrip()
+                         for name, value, share, count in rows)
+
+    def write(self, folder: Path):
+        """Write the `.prom` file and the JSON summary of the run to the folder"""
+        folder.mkdir(parents=True, exist_ok=True)
+        _write_atomic(folder.joinpath(TEXTFILE_NAME), self.textfile())
+        _write_atomic(folder.joinpath(SUMMARY_NAME), json.dumps(self.summary(), indent=4) + "\n")
+
+
+class TestMetrics(unittest.TestCase):
+    def test_10_timers_and_counters(self):
+        metrics = Metrics()
+        metrics.add_time("spreadsheet", 0.5, union="Union1")
+        metrics.add_time("spreadsheet", 0.25, union="Union1")
+        metrics.count("export_rows", 200)
+        metrics.success = True
+        metrics.finish()
+
+        summary = metrics.summary()
+        self.assertEqual(summary["phases"], [{"phase": "spreadsheet", "union": "Union1", "count": 2, "seconds": 0.75}])
+        self.assertEqual(summary["counters"], [{"name": "export_rows", "value": 200}])
+        self.assertTrue(summary["success"])
+
+    def test_20_textfile(self):
+        metrics = Metrics()
+        metrics.add_time("invoice", 1.5, union='The "A" Union')
+        metrics.count("emails_sent", 3)
+        text = metrics.textfile()
+
+        self.assertIn('safeticket_mailer_phase_seconds{phase="invoice",union="The \\"A\\" Union"} 1.5\n', text)
+        self.assertIn("# TYPE safeticket_mailer_emails_sent gauge\nsafeticket_mailer_emails_sent 3\n", text)
+        self.assertIn("safeticket_mailer_last_run_success 0\n", text)
+
+
+if __name__ == '__main__':
+    unittest.main()
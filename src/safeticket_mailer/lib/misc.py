@@ -1,31 +1,76 @@
 import argparse
+import csv
 import mimetypes
-import re
+import multiprocessing
+import pickle
 import smtplib
 import ssl
 import sys
 import io
+import threading
+import time
+import unittest
+import zipfile
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, Future
 from pathlib import Path
+from types import SimpleNamespace
 from email.header import Header
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import parseaddr
-from typing import List, Dict, Any, NamedTuple
+from typing import Callable, List, Dict, Any, NamedTuple, Mapping, Iterable, Iterator, Tuple, Optional, TextIO, Union
 
-try:
-    from odf import opendocument
-    from odf.table import Table, TableRow, TableCell, TableColumn
-    from odf.style import Style, TableColumnProperties, TableCellProperties, ParagraphProperties
-except ModuleNotFoundError:
-    print("You need to install odfpy to use this module: python3 -m pip install odfpy")
-    sys.exit(1)
+from .config import __file__ as config_example_file
+from .artifact_cache import ArtifactCache
+from .metrics import Metrics
+from .ods_writer import OdsWriter, string_cell, typed_cell
+from .outbox import Outbox, SentState
+from .ticket_table import TicketIndex, TicketTable
 
 
-from .config import __file__ as config_example_file
+# When the reports are made with --daemon, if the config file doesn't have a schedule: Every Monday at 07:00
+DEFAULT_SCHEDULE = "0 7 * * 1"
+
+# The fields of the tickets there is always used, no matter what is in the config file
+REQUIRED_TICKET_FIELDS = ['Billetnummer', 'Ordre', 'Tidspunkt', 'Billettype', 'Pris']
+
+
+def get_ticket_columns(config) -> List[str]:
+    """Return: All the fields of the tickets there is used in the run, based on the config file"""
+    columns = list(REQUIRED_TICKET_FIELDS)
+    for field in config.ticket_fields + [field for union in config.unions for field in union.ticket_fields_extra]:
+        if field not in columns:
+            columns.append(field)
+    return columns
+
+
+def read_tickets_csv(lines: Iterable[str], columns: List[str]) -> Tuple[List[str], Iterator[Dict[str, str]]]:
+    """
+    Parse the CSV export from SafeTicket, only the fields in `columns` are put into the rows
+    :return: The header (all the fields) of the CSV file and an iterator over the rows
+    """
+    _csv_reader = csv.reader(
+        lines,
+        skipinitialspace=True,
+        delimiter=';',
+        quotechar='"')
 
+    fieldnames = next(_csv_reader, [])
+    missing_columns = [column for column in columns if column not in fieldnames]
+    if missing_columns:
+        raise KeyError(*missing_columns)
 
-TicketTypesType = Dict[str, List[Dict[str, Any]]]
+    projection = [(column, fieldnames.index(column)) for column in columns]
+
+    def _rows() -> Iterator[Dict[str, str]]:
+        for row in _csv_reader:
+            # Skip empty lines like the `csv.DictReader` does
+            if row:
+                yield {column: row[index] if index < len(row) else None for column, index in projection}
+
+    return fieldnames, _rows()
 
 
 def args_parser():
@@ -62,6 +107,51 @@ def args_parser():
     parser.add_argument('--send-invoice', dest="send_invoice", action='store_true', default=False,
                         help="Send an invoice to all the unions that need one")
 
+    parser.add_argument('--full-export', dest="full_export", action='store_true', default=False,
+                        help="Always export all the tickets from SafeTicket, instead of using the local ticket store")
+    parser.add_argument('--ticket-store-max-age', dest="ticket_store_max_age", type=float, default=14 * 24,
+                        help="The max age in hours of the local ticket store, before a full export is forced, even "
+                             "if the number of sold tickets and the turnover of the event are the same. It has to be "
+                             "longer than the time between the runs, otherwise the store is never used. The default "
+                             "is two weeks, so with the weekly timer every second run is a full export "
+                             "(default: %(default)s)")
+
+    parser.add_argument('--flush-outbox', dest="flush_outbox", action='store_true', default=False,
+                        help="Only send the emails there is left in the outbox in the data folder, "
+                             "and retry the ones there fail")
+    parser.add_argument('--outbox-max-attempts', dest="outbox_max_attempts", type=int, default=5,
+                        help="The number of times an email in the outbox is tried with --flush-outbox, the wait "
+                             "between the attempts is doubled each time (default: %(default)s)")
+
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument('--record', dest="record", type=Path, default=None, metavar="FOLDER",
+                           help="Write all the responses from SafeTicket to the folder, so the run can be replayed "
+                                "with --replay")
+    recording.add_argument('--replay', dest="replay", type=Path, default=None, metavar="FOLDER",
+                           help="Use the responses from SafeTicket there was recorded with --record, instead of "
+                                "SafeTicket. Record with --full-export, so the export of the tickets is recorded")
+
+    parser.add_argument('--save-spreadsheets', dest="save_spreadsheets", action='store_true', default=False,
+                        help="Save a copy of the spreadsheets in /tmp, for debugging")
+
+    parser.add_argument('--no-artifact-cache', dest="artifact_cache", action='store_false', default=True,
+                        help="Always create the spreadsheets and invoices, instead of reusing them from the cache "
+                             "in the data folder")
+    parser.add_argument('--artifact-cache-size', dest="artifact_cache_size", type=int, default=200,
+                        help="The max size in MB of the spreadsheets and invoices in the cache, the least recently "
+                             "used are removed first (default: %(default)s)")
+
+    parser.add_argument('--jobs', '-j', dest="jobs", type=int, default=1,
+                        help="The number of unions there is handled at the same time (default: %(default)s)")
+
+    parser.add_argument('--daemon', dest="daemon", action='store_true', default=False,
+                        help="Keep running and make the reports each time the schedule says so. The config file is "
+                             "read again on SIGHUP")
+    parser.add_argument('--schedule', dest="schedule", type=str, default=None,
+                        help="The cron expression (minute hour day-of-month month day-of-week) for when the reports "
+                             "are made with --daemon, it overrides the 'schedule' in the config file "
+                             f"(default: '{DEFAULT_SCHEDULE}')")
+
     parser_past = parser.add_mutually_exclusive_group()
     parser_past.add_argument('--past', dest='past', action='store_true',
                              default=False, help='Find events from the past')
@@ -80,113 +170,94 @@ class MemoryFile(NamedTuple):
     filename: str
     data: bytes
 
+    @property
+    def size_estimate(self) -> int:
+        return len(self.data)
 
-class RowNumber():
-    _number: int
-    def __init__(self):
-        self._number = 0
 
-    def get(self) -> int:
-        self._number += 1
-        return self._number
-
-
-def create_spreadsheet_grouped_by_ticket_type_data(union, ticket_types: TicketTypesType, config) -> MemoryFile:
+class LazyFile:
+    """
+    A file there is only built when its data is used, like when `send_email` adds it to the email.
+    So the emails can be shown with `--show-emails` without building the attachments.
+    """
+    filename: str
+    size_estimate: int
+
+    def __init__(self, filename: str, size_estimate: int, submit: Callable[[], "Future[MemoryFile]"]):
+        """
+        :param size_estimate: About how many bytes the file will be
+        :param submit: Start building the file, it is only called once
+        """
+        self.filename = filename
+        self.size_estimate = size_estimate
+        self._submit = submit
+        self._future: Optional["Future[MemoryFile]"] = None
+        self._lock = threading.Lock()
+
+    def prepare(self):
+        """Start building the file without waiting for it, so more files can be built at the same time"""
+        with self._lock:
+            if self._future is None:
+                self._future = self._submit()
+
+    @property
+    def data(self) -> bytes:
+        self.prepare()
+        return self._future.result().data
+
+
+def create_spreadsheet_grouped_by_ticket_type_data(union, ticket_index: TicketIndex, config) -> MemoryFile:
     _width_in_cm = 2.64
     _number_characters = 12
     _average_character_length_in_cm = _width_in_cm / _number_characters
 
     column_names = config.ticket_fields + union.ticket_fields_extra
+    table_style_name = "table=all"
 
-    doc = opendocument.OpenDocumentSpreadsheet()
-    table_all = Table(name='all', stylename="table=all")
-
-    union_tickets = sum([ticket for ticket_name, ticket in ticket_types.items()
-                         if ticket_name in union.ticket_type_names], [])
-    for index, column in enumerate(column_names):
-        style_name = f"{table_all.getAttribute('stylename')}|column={index+1}"
-        table_column = TableColumn(stylename=style_name)
-        table_all.addElement(table_column)
-
-        calc_length_in_cm = max(
-            [len(union_ticket[column_names[index]])
-             for union_ticket in union_tickets
-             if union_ticket.get("Ordre") != "manual-ticket"] + [len(column)]
-        ) * _average_character_length_in_cm + 0.2
-
-        style = Style(name=style_name, family=table_column.qname[1])
-        style.addElement(TableColumnProperties(columnwidth=f"{calc_length_in_cm:0.2f}cm"))
-        doc.automaticstyles.addElement(style)
-
-    for header_index, ticket_type_name in enumerate(union.ticket_type_names):
-        tickets = ticket_types[ticket_type_name]
-
-        if tickets:
-            row_ticket_name = TableRow()
-
-            style_name = f"{table_all.getAttribute('stylename')}|header={header_index + 1}"
-            cell_ticket_name = TableCell(
-                stylename=style_name,
-                stringvalue=ticket_type_name, valuetype="string",
-                numbercolumnsspanned=column_names.__len__(),
-            )
-            style = Style(name=style_name, family=cell_ticket_name.qname[1])
-            style.addElement(ParagraphProperties(textalign="center"))
-            doc.automaticstyles.addElement(style)
-
-            row_ticket_name.addElement(cell_ticket_name)
-            table_all.addElement(row_ticket_name)
-
-            row_header = TableRow()
-            for column_index, column in enumerate(column_names):
-                style_name = f"{table_all.getAttribute('stylename')}|column={column_index+1}|header={header_index + 1}"
-                row_header.addElement(
-                    TableCell(
-                        stylename=style_name,
-                        stringvalue=column, valuetype="string",
-                    )
-                )
-                style = Style(name=style_name, family=cell_ticket_name.qname[1])
-                style.addElement(TableCellProperties(borderbottom="0.74pt groove #000000"))
-                doc.automaticstyles.addElement(style)
-            table_all.addElement(row_header)
+    data = io.BytesIO()
+    with OdsWriter(data, table_name="all", table_style_name=table_style_name) as writer:
+        for index, column in enumerate(column_names):
+            calc_length_in_cm = max(
+                ticket_index.column_width(union.ticket_type_names, column), len(column)
+            ) * _average_character_length_in_cm + 0.2
+
+            writer.add_column(style_name=f"{table_style_name}|column={index+1}", width=f"{calc_length_in_cm:0.2f}cm")
+
+        # The styles have to be there before the rows, so add the styles of the headers first
+        ticket_types = []
+        for header_index, ticket_type_name in enumerate(union.ticket_type_names):
+            tickets = ticket_index.ticket_type(ticket_type_name)
+            if tickets:
+                ticket_types.append((header_index, ticket_type_name, tickets))
+
+                writer.add_cell_style(f"{table_style_name}|header={header_index + 1}",
+                                      paragraph_properties={"fo:text-align": "center"})
+                for column_index, column in enumerate(column_names):
+                    writer.add_cell_style(f"{table_style_name}|column={column_index+1}|header={header_index + 1}",
+                                          table_cell_properties={"fo:border-bottom": "0.74pt groove #000000"})
+
+        for header_index, ticket_type_name, tickets in ticket_types:
+            writer.write_row([string_cell(
+                ticket_type_name,
+                style_name=f"{table_style_name}|header={header_index + 1}",
+                columns_spanned=len(column_names),
+            )])
+
+            writer.write_row([
+                string_cell(column, style_name=f"{table_style_name}|column={column_index+1}|header={header_index + 1}")
+                for column_index, column in enumerate(column_names)
+            ])
 
             for ticket in tickets:
-                ticket_row = TableRow()
-                for header_column in column_names:
-                    value = ticket[header_column]
-                    if re.search(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}$", value):
-                        ticket_row.addElement(TableCell(
-                            datevalue=value, valuetype="date",
-                        ))
-
-                    elif re.search(r"^[0-9]+$", value):
-                        ticket_row.addElement(TableCell(
-                            value=value, valuetype="float",
-                        ))
-
-                    else:
-                        ticket_row.addElement(TableCell(
-                            stringvalue=value, valuetype="string",
-                        ))
-
-                table_all.addElement(ticket_row)
+                writer.write_row([typed_cell(ticket.typed(header_column)) for header_column in column_names])
 
             for _ in range(2):
-                table_all.addElement(TableRow())
-
-    doc.spreadsheet.addElement(table_all)
-
-    doc.save(f"/tmp/grouped-by-type.{union.name}.ods")
+                writer.write_row()
 
-    data = io.BytesIO()
-    doc.write(data)
-    data.seek(0)
-
-    return MemoryFile(filename="tickets-sold_grouped-by-type.ods", data=data.read())
+    return MemoryFile(filename="tickets-sold_grouped-by-type.ods", data=data.getvalue())
 
 
-def order_ticket_types(ticket: Dict[str, Any]) -> int:
+def order_ticket_types(ticket: Mapping[str, Any]) -> int:
     value = 0
     if 'Voksen' in ticket['Billettype']:
         value += 100
@@ -194,135 +265,201 @@ def order_ticket_types(ticket: Dict[str, Any]) -> int:
         value += 10
     return value
 
-def add_cell_format_in_correct_format(row: TableRow, value: str):
-    if re.search(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}$", value):
-        row.addElement(TableCell(
-            datevalue=value, valuetype="date",
-        ))
-
-    elif re.search(r"^[0-9]+$", value):
-        row.addElement(TableCell(
-            value=value, valuetype="float",
-        ))
 
-    else:
-        row.addElement(TableCell(
-            stringvalue=value, valuetype="string",
-        ))
-
-def create_spreadsheet_grouped_by_buyer_data(union, ticket_types: TicketTypesType, config) -> MemoryFile:
+def create_spreadsheet_grouped_by_buyer_data(union, ticket_index: TicketIndex, config) -> MemoryFile:
     _width_in_cm = 2.63
     _number_characters = 12
     _average_character_length_in_cm = _width_in_cm / _number_characters
 
     column_names_ticket_fields = ["Billettype"] + config.ticket_fields
     column_names = column_names_ticket_fields + union.ticket_fields_extra
+    table_style_name = "table=all"
 
-    doc = opendocument.OpenDocumentSpreadsheet()
-    table_all = Table(name='all', stylename="table=all")
-
-
-    union_tickets = sum([ticket for ticket_name, ticket in ticket_types.items()
-                         if ticket_name in union.ticket_type_names], [])
-    for index, column in enumerate(column_names):
-        style_name = f"{table_all.getAttribute('stylename')}|column={index+1}"
-        table_column = TableColumn(stylename=style_name)
-        table_all.addElement(table_column)
-
-        calc_length_in_cm = max(
-            [len(union_ticket[column_names[index]])
-             for union_ticket in union_tickets
-             if union_ticket.get("Ordre") != "manual-ticket"] + [len(column)]
-        ) * _average_character_length_in_cm + 0.2
-
-        style = Style(name=style_name, family=table_column.qname[1])
-        style.addElement(TableColumnProperties(columnwidth=f"{calc_length_in_cm:0.2f}cm"))
-        doc.automaticstyles.addElement(style)
-
-    group_by_buyer = {}
-    for ticket_type_name in union.ticket_type_names:
-        tickets = ticket_types[ticket_type_name]
-        for ticket in tickets:
-            group_by_buyer.setdefault(ticket["Ordre"], [])
-            group_by_buyer[ticket["Ordre"]].append(ticket)
-    for ordre_index in group_by_buyer:
-        group_by_buyer[ordre_index].sort(key=order_ticket_types, reverse=True)
-
-
-    header_index = 0
-    style_family = "table-cell"
-    style_name = f"{table_all.getAttribute('stylename')}|header={header_index + 1}"
-    style = Style(name=style_name, family=style_family)
-    style.addElement(ParagraphProperties(textalign="center"))
-    doc.automaticstyles.addElement(style)
-
-    row_header = TableRow()
-    for column_index, column in enumerate(column_names):
-        style_name = f"{table_all.getAttribute('stylename')}|column={column_index+1}|header={header_index + 1}"
-        row_header.addElement(
-            TableCell(
-                stylename=style_name,
-                stringvalue=column, valuetype="string",
-            )
-        )
-        style = Style(name=style_name, family=style_family)
-        style.addElement(TableCellProperties(borderbottom="0.74pt groove #000000"))
-        doc.automaticstyles.addElement(style)
-    table_all.addElement(row_header)
-
-    for ticket_order, tickets in group_by_buyer.items():
-        for ticket_index, ticket in enumerate(tickets):
-            if ticket_index == 0:
-                ticket_row = TableRow()
-                for header_column in column_names:
-                    value = ticket[header_column]
-                    add_cell_format_in_correct_format(row=ticket_row, value=value)
-
-                table_all.addElement(ticket_row)
-
-            else:
-                ticket_row = TableRow()
-                for header_column in column_names_ticket_fields:
-                    add_cell_format_in_correct_format(row=ticket_row, value=ticket[header_column])
-                table_all.addElement(ticket_row)
-
-        row_sum = TableRow()
-        row_sum.addElement(TableCell(
-            stylename=style_name,
-            stringvalue=f"Antal billetter købt: {len(tickets)}", valuetype="string",
-        ))
-        table_all.addElement(row_sum)
+    group_by_buyer = {ticket_order: sorted(tickets, key=order_ticket_types, reverse=True)
+                      for ticket_order, tickets in ticket_index.orders(union.name).items()}
 
-        for _ in range(1):
-            table_all.addElement(TableRow())
+    data = io.BytesIO()
+    with OdsWriter(data, table_name="all", table_style_name=table_style_name) as writer:
+        for index, column in enumerate(column_names):
+            calc_length_in_cm = max(
+                ticket_index.column_width(union.ticket_type_names, column), len(column)
+            ) * _average_character_length_in_cm + 0.2
+
+            writer.add_column(style_name=f"{table_style_name}|column={index+1}", width=f"{calc_length_in_cm:0.2f}cm")
+
+        header_index = 0
+        header_style_names = [f"{table_style_name}|column={column_index+1}|header={header_index + 1}"
+                              for column_index, _ in enumerate(column_names)]
+        for style_name in header_style_names:
+            writer.add_cell_style(style_name, table_cell_properties={"fo:border-bottom": "0.74pt groove #000000"})
+
+        writer.write_row([string_cell(column, style_name=style_name)
+                          for column, style_name in zip(column_names, header_style_names)])
+
+        for ticket_order, tickets in group_by_buyer.items():
+            for ticket_number, ticket in enumerate(tickets):
+                # Only the first ticket of the order have the extra fields of the union
+                columns = column_names if ticket_number == 0 else column_names_ticket_fields
+                writer.write_row([typed_cell(ticket.typed(header_column)) for header_column in columns])
+
+            # The sum uses the style of the last header cell
+            writer.write_row([string_cell(f"Antal billetter købt: {len(tickets)}", style_name=header_style_names[-1])])
+
+            for _ in range(1):
+                writer.write_row()
+
+    return MemoryFile(filename="tickets-sold_grouped-by-buyer.ods", data=data.getvalue())
+
+
+# The state of the worker processes of the `SpreadsheetPool`, it is set by `_init_spreadsheet_worker`
+_spreadsheet_worker_state: Dict[str, Any] = {}
+
+
+def _spreadsheet_config(config) -> SimpleNamespace:
+    """
+    Return: The part of the config there is used to build the spreadsheets. The config itself can't be pickled,
+    because its class is from the config file, which the worker processes can't import
+    """
+    return SimpleNamespace(
+        ticket_fields=list(config.ticket_fields),
+        unions=[SimpleNamespace(name=union.name, ticket_type_names=list(union.ticket_type_names),
+                                ticket_fields_extra=list(union.ticket_fields_extra)) for union in config.unions])
+
+
+def _init_spreadsheet_worker(state: bytes):
+    """:param state: The pickled ticket index and config, they are only pickled once for all the workers"""
+    _spreadsheet_worker_state.update(pickle.loads(state))
+
+
+def _build_spreadsheet(kind: str, union_index: int) -> Tuple[MemoryFile, float]:
+    """Return: The spreadsheet and the number of seconds it took to build it"""
+    start_time = time.perf_counter()
+    config = _spreadsheet_worker_state["config"]
+    spreadsheet = SpreadsheetPool.builders[kind](
+        union=config.unions[union_index],
+        ticket_index=_spreadsheet_worker_state["ticket_index"],
+        config=config)
+    return spreadsheet, time.perf_counter() - start_time
+
+
+class SpreadsheetPool:
+    """
+    Builds the spreadsheets in worker processes, because building them is CPU bound.
+    The workers are started by a fork server, because forking this process copies the locks there is held by its
+    other threads (like the outbox worker) in the moment of the fork, so the workers get the tickets and the config
+    pickled. With only one job, the spreadsheets are built in the current process.
+    The spreadsheets are reused from the artifact cache, if the tickets of the union haven't changed.
+    """
+    builders = {
+        "grouped-by-type": create_spreadsheet_grouped_by_ticket_type_data,
+        "grouped-by-buyer": create_spreadsheet_grouped_by_buyer_data,
+    }
+
+    # Change it when the layout of the spreadsheets is changed, so the cached spreadsheets are not used
+    version = "5"
+
+    def __init__(self, jobs: int, ticket_index: TicketIndex, config, artifact_cache: Optional[ArtifactCache] = None,
+                 metrics: Optional[Metrics] = None):
+        """:param metrics: Where the time it takes to build each spreadsheet is added"""
+        state = {"ticket_index": ticket_index, "config": _spreadsheet_config(config)}
+        _spreadsheet_worker_state.update(state)
+        self._ticket_index = ticket_index
+        self._config = config
+        self._artifact_cache = artifact_cache
+        self._metrics = metrics
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        if jobs > 1:
+            context = multiprocessing.get_context("forkserver")
+            # The fork server imports this module once, and the workers are forked from it with it imported
+            context.set_forkserver_preload([__name__])
+            self._executor = ProcessPoolExecutor(
+                max_workers=jobs, mp_context=context,
+                initializer=_init_spreadsheet_worker,
+                initargs=(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL),))
+            # All the worker processes are started on the first job, so do it now, while the invoices are rendered
+            self._executor.submit(int)
+
+    def _artifact_key(self, kind: str, union_index: int) -> str:
+        union = self._config.unions[union_index]
+        fields = self._config.ticket_fields + union.ticket_fields_extra
+        return ArtifactCache.key(
+            "spreadsheet", kind, self.version,
+            repr(union.ticket_type_names), repr(fields),
+            self._ticket_index.union_digest(union.name, columns=["Billettype", "Ordre"] + fields),
+        )
 
-    doc.spreadsheet.addElement(table_all)
+    def _built(self, kind: str, union_index: int, key: Optional[str], built: "Future[Tuple[MemoryFile, float]]",
+               future: "Future[MemoryFile]"):
+        if built.exception() is not None:
+            future.set_exception(built.exception())
+            return
+
+        spreadsheet, build_time = built.result()
+        if self._metrics is not None:
+            self._metrics.add_time("spreadsheet", build_time, kind=kind, union=self._config.unions[union_index].name)
+            self._metrics.count("spreadsheets_built")
+        if key is not None:
+            self._artifact_cache.put(key, spreadsheet.data)
+        future.set_result(spreadsheet)
+
+    def submit(self, kind: str, union_index: int) -> "Future[MemoryFile]":
+        future = Future()
+
+        key = None
+        if self._artifact_cache is not None:
+            key = self._artifact_key(kind, union_index)
+            data = self._artifact_cache.get(key)
+            if data is not None:
+                if self._metrics is not None:
+                    self._metrics.count("spreadsheets_cached")
+                future.set_result(MemoryFile(filename=f"tickets-sold_{kind}.ods", data=data))
+                return future
+
+        if self._executor is not None:
+            built = self._executor.submit(_build_spreadsheet, kind, union_index)
+        else:
+            built = Future()
+            try:
+                built.set_result(_build_spreadsheet(kind, union_index))
+            except Exception as e:
+                built.set_exception(e)
 
-    doc.save(f"/tmp/grouped-by-buyer.{union.name}.ods")
+        built.add_done_callback(lambda done: self._built(kind, union_index, key, done, future))
+        return future
 
-    data = io.BytesIO()
-    doc.write(data)
-    data.seek(0)
+    def file(self, kind: str, union_index: int) -> LazyFile:
+        """Return: The spreadsheet as a file there is first built (or found in the artifact cache) when it is used"""
+        union = self._config.unions[union_index]
+        fields = self._config.ticket_fields + union.ticket_fields_extra
+        # About 8 bytes for each compressed cell and 2 kB for the rest of the ODS file
+        size_estimate = 2048 + 8 * len(self._ticket_index.unions[union.name]) * (len(fields) + 1)
+        return LazyFile(filename=f"tickets-sold_{kind}.ods", size_estimate=size_estimate,
+                        submit=lambda: self.submit(kind, union_index=union_index))
 
-    return MemoryFile(filename="tickets-sold_grouped-by-buyer.ods", data=data.read())
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
 
 
 def show_email(msg: str, union, subject: str, cc_emails: List[str],
-               attachments: List[MemoryFile] = None):
+               attachments: List[Union[MemoryFile, LazyFile]] = None, file: TextIO = None):
     cc_emails = cc_emails if cc_emails else []
+    file = file if file else sys.stdout
 
-    print('\n============(Mail - {})============'.format(union.name))
-    print('TO:         {}'.format(union.to_email))
+    print('\n============(Mail - {})============'.format(union.name), file=file)
+    print('TO:         {}'.format(union.to_email), file=file)
     for cc_email in cc_emails:
         if cc_email:
-            print('CC:         {}'.format(cc_email))
-    print('FROM:       {}'.format(union.from_email))
-    print('SUBJECT:    {}'.format(subject))
+            print('CC:         {}'.format(cc_email), file=file)
+    print('FROM:       {}'.format(union.from_email), file=file)
+    print('SUBJECT:    {}'.format(subject), file=file)
     if attachments:
         for attachment in attachments:
-            print('Attachment: {}'.format(attachment.filename))
-    print('\n---------------------------')
-    print(msg)
+            if attachment:
+                print('Attachment: {}'.format(attachment.filename), file=file)
+    print('\n---------------------------', file=file)
+    print(msg, file=file)
 
 
 # This is need because there is a bug in MIMEText
@@ -331,57 +468,200 @@ def encode_email_address_name(email_address: str) -> str:
     return '{} <{}>'.format(Header(name).encode('utf-8'), address)
 
 
+class SMTPTransport:
+    """
+    One SMTP session there is used for all the emails in a run, so the TLS handshake and the login
+    is only done once. The connection is checked with a NOOP before it is reused, and it reconnects
+    if the server have closed the connection in the meantime.
+    """
+    latencies: List[float]
+
+    def __init__(self, config):
+        self._config = config
+        self._smtp: Optional[smtplib.SMTP_SSL] = None
+        self._lock = threading.Lock()
+        self.latencies = []
+
+    def __enter__(self) -> "SMTPTransport":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _connect(self):
+        context = ssl.create_default_context()
+        if getattr(self._config.SMTP, 'use_ssl', True):
+            self._smtp = smtplib.SMTP_SSL(self._config.SMTP.host, self._config.SMTP.port, context=context)
+        else:
+            self._smtp = smtplib.SMTP(self._config.SMTP.host, self._config.SMTP.port)
+            self._smtp.ehlo()
+            if self._smtp.has_extn("starttls"):
+                self._smtp.starttls(context=context)
+        self._smtp.login(self._config.SMTP.username, self._config.SMTP.password)
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except smtplib.SMTPException:
+                self._smtp.close()
+            self._smtp = None
+
+    def _is_connected(self) -> bool:
+        if self._smtp is None:
+            return False
+        try:
+            return self._smtp.noop()[0] == 250
+        except (smtplib.SMTPServerDisconnected, OSError):
+            return False
+
+    def send(self, from_addr: str, to_addrs: List[str], msg: str) -> float:
+        """Return: The number of seconds it took to send the email"""
+        with self._lock:
+            start_time = time.monotonic()
+
+            if not self._is_connected():
+                self._disconnect()
+                self._connect()
+
+            try:
+                self._smtp.sendmail(from_addr=from_addr, to_addrs=to_addrs, msg=msg)
+            except smtplib.SMTPServerDisconnected:
+                # The server closed the connection between the NOOP and the email, so try again once
+                self._disconnect()
+                self._connect()
+                self._smtp.sendmail(from_addr=from_addr, to_addrs=to_addrs, msg=msg)
+
+            latency = time.monotonic() - start_time
+            self.latencies.append(latency)
+            return latency
+
+    def take_latencies(self) -> List[float]:
+        """Return: The latencies of the emails sent since the last time, they are removed from `latencies`"""
+        with self._lock:
+            latencies, self.latencies = self.latencies, []
+        return latencies
+
+    def close(self):
+        with self._lock:
+            try:
+                self._disconnect()
+            except OSError:
+                self._smtp = None
+
+
 def send_email(
         msg: str,
         union,
         cc_emails: List[str],
         bcc_emails: List[str],
         config,
-        attachments: List[MemoryFile] = None,
+        attachments: List[Union[MemoryFile, LazyFile]] = None,
         overwrite_email_receiver: str = None,
-):
-    context = ssl.create_default_context()
+        transport: Optional[SMTPTransport] = None,
+        outbox: Optional[Outbox] = None,
+        sent_state: Optional[SentState] = None,
+        sent_kind: Optional[str] = None,
+) -> Optional[float]:
+    """
+    :param transport: The SMTP session to send the email with, a new session is used if it is `None`
+    :param outbox: Write the email to the outbox instead of sending it, it is then sent by an `OutboxWorker`
+    or with `--flush-outbox`
+    :param sent_state: The sent state there is updated, when the email is delivered
+    :param sent_kind: The kind of email in the sent state (`status`, `last-status` or `invoice`)
+    Return: The number of seconds it took to send the email, or None if it was written to the outbox
+    """
+    email = MIMEMultipart()
+    email.attach(MIMEText(msg))
+    email['To'] = encode_email_address_name(union.to_email)
+
+    if union.cc_email:
+        union_cc_email = [union.cc_email]
+    else:
+        union_cc_email = []
+    merged_cc_emails = list(set(union_cc_email + cc_emails))
 
-    with smtplib.SMTP_SSL(config.SMTP.host, config.SMTP.port, context=context) as smtpObj:
-        email = MIMEMultipart()
-        email.attach(MIMEText(msg))
-        email['To'] = encode_email_address_name(union.to_email)
+    if merged_cc_emails:
+        email['CC'] = ', '.join([encode_email_address_name(cc_email)
+                                 for cc_email in merged_cc_emails
+                                 if cc_email])
+    email['From'] = encode_email_address_name(union.from_email)
+    email['Subject'] = union.subject
 
-        if union.cc_email:
-            union_cc_email = [union.cc_email]
-        else:
-            union_cc_email = []
-        merged_cc_emails = list(set(union_cc_email + cc_emails))
-
-        if merged_cc_emails:
-            email['CC'] = ', '.join([encode_email_address_name(cc_email)
-                                     for cc_email in merged_cc_emails
-                                     if cc_email])
-        email['From'] = encode_email_address_name(union.from_email)
-        email['Subject'] = union.subject
-
-        if attachments:
-            for attachment in attachments:
-                _type, _encoding = mimetypes.guess_type(url=attachment.filename)
-                email.attach(MIMEApplication(
-                    _data=attachment.data,
-                    _subtype="octet-stream" if _type is None else _type.split("/")[-1],
-                    name=attachment.filename,
-                ))
-
-        smtpObj.login(config.SMTP.username, config.SMTP.password)
-
-        # Make sure we only get the address and not the name
-        receivers = [parseaddr(union.to_email)[1]]
-
-        if merged_cc_emails:
-            receivers.extend([parseaddr(cc_email)[1] for cc_email in merged_cc_emails if cc_email])
-
-        if bcc_emails:
-            receivers.extend([parseaddr(bcc_email)[1] for bcc_email in bcc_emails if bcc_emails])
-
-        smtpObj.sendmail(
-            from_addr=union.from_email,
-            to_addrs=[overwrite_email_receiver] if overwrite_email_receiver else receivers,
-            msg=email.as_string()
-        )
+    if attachments:
+        attachments = list(filter(None, attachments))
+        # Start building all the lazy attachments, before waiting for the first of them
+        for attachment in attachments:
+            if isinstance(attachment, LazyFile):
+                attachment.prepare()
+
+        for attachment in attachments:
+            _type, _encoding = mimetypes.guess_type(url=attachment.filename)
+            email.attach(MIMEApplication(
+                _data=attachment.data,
+                _subtype="octet-stream" if _type is None else _type.split("/")[-1],
+                name=attachment.filename,
+            ))
+
+    # Make sure we only get the address and not the name
+    receivers = [parseaddr(union.to_email)[1]]
+
+    if merged_cc_emails:
+        receivers.extend([parseaddr(cc_email)[1] for cc_email in merged_cc_emails if cc_email])
+
+    if bcc_emails:
+        receivers.extend([parseaddr(bcc_email)[1] for bcc_email in bcc_emails if bcc_emails])
+
+    to_addrs = [overwrite_email_receiver] if overwrite_email_receiver else receivers
+
+    if outbox is not None:
+        outbox.enqueue(from_addr=union.from_email, to_addrs=to_addrs, msg=email.as_string(),
+                       union_name=union.name, sent_state=sent_state, sent_kind=sent_kind)
+        return None
+
+    with nullcontext(transport) if transport is not None else SMTPTransport(config) as smtp_transport:
+        latency = smtp_transport.send(from_addr=union.from_email, to_addrs=to_addrs, msg=email.as_string())
+
+    if sent_state is not None:
+        sent_state.mark_sent(sent_kind, union.name)
+    return latency
+
+
+class TestSpreadsheetPool(unittest.TestCase):
+    def test_10_workers(self):
+        # Like the config file, the class of the config can't be pickled
+        class Union:
+            name = "Union1"
+            ticket_type_names = ["Voksen", "Barn"]
+            ticket_fields_extra = ["Email"]
+
+        class Config:
+            ticket_fields = ["Ordre", "Navn", "Pris"]
+            unions = [Union()]
+
+        table = TicketTable(["Billettype", "Ordre", "Navn", "Pris", "Email"])
+        for index in range(20):
+            table.append({"Billettype": "Voksen" if index % 3 else "Barn", "Ordre": str(index // 2),
+                          "Navn": f"Navn {index}", "Pris": "1.234,50", "Email": f"e{index}@example.com"})
+        ticket_index = TicketIndex(table, Config.unions)
+
+        spreadsheets = []
+        for jobs in (1, 2):
+            spreadsheet_pool = SpreadsheetPool(jobs=jobs, ticket_index=ticket_index, config=Config())
+            try:
+                spreadsheets.append([spreadsheet_pool.submit(kind, 0).result(timeout=60)
+                                     for kind in SpreadsheetPool.builders])
+            finally:
+                spreadsheet_pool.close()
+
+        def content(spreadsheet: MemoryFile) -> bytes:
+            # The time in the zip file is when the spreadsheet was built
+            with zipfile.ZipFile(io.BytesIO(spreadsheet.data)) as ods_file:
+                return ods_file.read("content.xml")
+
+        self.assertEqual([content(spreadsheet) for spreadsheet in spreadsheets[0]],
+                         [content(spreadsheet) for spreadsheet in spreadsheets[1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
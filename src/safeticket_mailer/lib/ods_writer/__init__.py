@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
+import io
+import re
+import unittest
+import zipfile
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Tuple
+from xml.dom import minidom
+from xml.sax.saxutils import quoteattr
+
+
+MIMETYPE = "application/vnd.oasis.opendocument.spreadsheet"
+
+NAMESPACES = (
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+    'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+    'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+    'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+    'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0" '
+    'xmlns:meta="urn:oasis:names:tc:opendocument:xmlns:meta:1.0"'
+)
+XML_DECLARATION = "<?xml version='1.0' encoding='UTF-8'?>\n"
+
+# The attributes are also escaped for the whitespace there would be normalized by the XML parser
+_ATTRIBUTE_ENTITIES = {"\n": "&#10;", "\r": "&#13;", "\t": "&#9;"}
+
+# The characters there is not allowed in XML 1.0, not even as an entity (like the vertical tab `\x0b`), they
+# are removed from the texts, otherwise the spreadsheet can't be opened
+_ILLEGAL_XML_CHARACTERS = re.compile("[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+
+# The number of rows there is written to the zip stream at a time
+_ROWS_PER_WRITE = 512
+
+
+def _attributes(attributes: Iterable[Tuple[str, Optional[str]]]) -> str:
+    return "".join(f" {name}={quoteattr(_ILLEGAL_XML_CHARACTERS.sub('', value), _ATTRIBUTE_ENTITIES)}"
+                   for name, value in attributes if value is not None)
+
+
+def string_cell(value: str, style_name: Optional[str] = None, columns_spanned: Optional[int] = None) -> str:
+    """Return: The XML of a cell with a text"""
+    return "<table:table-cell{}/>".format(_attributes((
+        ("table:style-name", style_name),
+        ("office:string-value", value),
+        ("office:value-type", "string"),
+        ("table:number-columns-spanned", None if columns_spanned is None else str(columns_spanned)),
+    )))
+
+
+def typed_cell(value: Any) -> str:
+    """
+    :param value: A typed value from the ticket table, like `TicketRow.typed`
+    Return: The XML of a cell, there is a date, a number or a text depending on the type of the value
+    """
+    if isinstance(value, datetime):
+        return f'<table:table-cell office:date-value="{value.isoformat()}" office:value-type="date"/>'
+
+    elif isinstance(value, (int, Decimal)):
+        return f'<table:table-cell office:value="{value}" office:value-type="float"/>'
+
+    return string_cell(str(value))
+
+
+class OdsWriter:
+    """
+    Writes a spreadsheet with one table to an ODS file, one row at a time, so the spreadsheet is never
+    held in memory as a tree of elements. The styles and columns have to be added before the first row.
+    """
+    def __init__(self, file: BinaryIO, table_name: str, table_style_name: Optional[str] = None):
+        """
+        :param file: The file or buffer the ODS file is written to, it have to be open for writing
+        """
+        self._zip = zipfile.ZipFile(file, mode="w", compression=zipfile.ZIP_DEFLATED)
+        # The mimetype have to be the first file in the zip file, and it can't be compressed
+        self._zip.writestr(zipfile.ZipInfo("mimetype"), MIMETYPE, compress_type=zipfile.ZIP_STORED)
+
+        self._table_name = table_name
+        self._table_style_name = table_style_name
+        self._styles: List[str] = []
+        self._columns: List[str] = []
+        self._content = None
+        self._rows: List[str] = []
+
+    def __enter__(self) -> "OdsWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _add_style(self, name: str, family: str, properties: str):
+        if self._content is not None:
+            raise RuntimeError("The styles have to be added before the first row")
+        self._styles.append('<style:style{}>{}</style:style>'.format(
+            _attributes((("style:name", name), ("style:family", family), ("style:display-name", name))),
+            properties))
+
+    def add_column(self, style_name: str, width: str):
+        """Add a column with its own style, the columns are in the order they are added"""
+        self._add_style(style_name, "table-column",
+                        f'<style:table-column-properties style:column-width={quoteattr(width)}/>')
+        self._columns.append(f'<table:table-column{_attributes([("table:style-name", style_name)])}/>')
+
+    def add_cell_style(self, style_name: str, table_cell_properties: Optional[Dict[str, str]] = None,
+                       paragraph_properties: Optional[Dict[str, str]] = None):
+        """
+        :param table_cell_properties: Like `{"fo:border-bottom": "0.74pt groove #000000"}`
+        :param paragraph_properties: Like `{"fo:text-align": "center"}`
+        """
+        properties = ""
+        if paragraph_properties:
+            properties += f"<style:paragraph-properties{_attributes(paragraph_properties.items())}/>"
+        if table_cell_properties:
+            properties += f"<style:table-cell-properties{_attributes(table_cell_properties.items())}/>"
+        self._add_style(style_name, "table-cell", properties)
+
+    def _start_content(self):
+        self._content = self._zip.open("content.xml", mode="w")
+        self._content.write("".join((
+            XML_DECLARATION,
+            f'<office:document-content {NAMESPACES} office:version="1.2">',
+            "<office:automatic-styles>", *self._styles, "</office:automatic-styles>",
+            "<office:body><office:spreadsheet>",
+            "<table:table{}>".format(_attributes((("table:name", self._table_name),
+                                                  ("table:style-name", self._table_style_name)))),
+            *self._columns,
+        )).encode())
+
+    def _flush_rows(self):
+        self._content.write("".join(self._rows).encode())
+        self._rows.clear()
+
+    def write_row(self, cells: Iterable[str] = ()):
+        """
+        :param cells: The XML of the cells, from `string_cell` or `typed_cell`. An empty row is written,
+        if there are no cells
+        """
+        if self._content is None:
+            self._start_content()
+
+        row = "".join(cells)
+        self._rows.append(f"<table:table-row>{row}</table:table-row>" if row else "<table:table-row/>")
+        if len(self._rows) >= _ROWS_PER_WRITE:
+            self._flush_rows()
+
+    def close(self):
+        if self._zip.fp is None:
+            return
+
+        if self._content is None:
+            self._start_content()
+        self._flush_rows()
+        self._content.write(b"</table:table></office:spreadsheet></office:body></office:document-content>")
+        self._content.close()
+
+        self._zip.writestr("styles.xml", "".join((
+            XML_DECLARATION,
+            f'<office:document-styles {NAMESPACES} office:version="1.2">',
+            "<office:styles/><office:automatic-styles/>",
+            "</office:document-styles>",
+        )))
+        self._zip.writestr("meta.xml", "".join((
+            XML_DECLARATION,
+            f'<office:document-meta {NAMESPACES} office:version="1.2">',
+            "<office:meta><meta:generator>safeticket-mailer</meta:generator></office:meta>",
+            "</office:document-meta>",
+        )))
+        self._zip.writestr("META-INF/manifest.xml", "".join((
+            XML_DECLARATION,
+            '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" '
+            'manifest:version="1.2">',
+            f'<manifest:file-entry manifest:full-path="/" manifest:version="1.2" manifest:media-type="{MIMETYPE}"/>',
+            '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>',
+            '<manifest:file-entry manifest:full-path="styles.xml" manifest:media-type="text/xml"/>',
+            '<manifest:file-entry manifest:full-path="meta.xml" manifest:media-type="text/xml"/>',
+            "</manifest:manifest>",
+        )))
+        self._zip.close()
+
+
+class TestOdsWriter(unittest.TestCase):
+    def test_10_cells(self):
+        file = io.BytesIO()
+        with OdsWriter(file, "Tickets") as writer:
+            writer.write_row([string_cell("Vej\x0b 1\x00\n2 😀"), typed_cell("0800"), typed_cell(Decimal("1234.50")),
+                              typed_cell(datetime(2024, 6, 1, 12))])
+
+        with zipfile.ZipFile(file) as ods_file:
+            content = minidom.parseString(ods_file.read("content.xml"))
+        cells = content.getElementsByTagName("table:table-cell")
+        self.assertEqual(cells[0].getAttribute("office:string-value"), "Vej 1\n2 😀")
+        self.assertEqual(cells[1].getAttribute("office:string-value"), "0800")
+        self.assertEqual(cells[2].getAttribute("office:value"), "1234.50")
+        self.assertEqual(cells[3].getAttribute("office:date-value"), "2024-06-01T12:00:00")
+
+
+if __name__ == '__main__':
+    unittest.main()
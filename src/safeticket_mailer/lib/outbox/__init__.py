@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
+import io
+import json
+import os
+import smtplib
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import unittest
+import uuid
+from datetime import datetime, UTC
+from pathlib import Path
+from typing import Dict, List, Any, Optional, Tuple
+
+
+# The delay before the first retry of an email, it is doubled for each failed attempt
+RETRY_DELAY = 30
+RETRY_DELAY_MAX = 60 * 60
+
+
+def _write_atomic(path: Path, content: bytes):
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+
+
+class SentState:
+    """
+    Keeps track of which emails there have been sent to the unions, in JSON files in the data folder.
+    The files are read and written while holding a lock, so the unions can be handled in threads.
+    """
+    folder: Path
+
+    # The name of the file and the empty content of it
+    _files = {
+        "invoice": ("sent-invoice-mail.json", []),
+        "last-status": ("sent-last-status-mail.json", []),
+        "status": ("sent-status-mail.json", {}),
+    }
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+        self._lock = threading.Lock()
+
+        for filename, empty in self._files.values():
+            path = self.folder.joinpath(filename)
+            if not path.is_file():
+                path.write_text(json.dumps(empty, indent=4))
+
+    def _path(self, kind: str) -> Path:
+        return self.folder.joinpath(self._files[kind][0])
+
+    def is_sent(self, kind: str, union_name: str) -> bool:
+        with self._lock:
+            return union_name in json.loads(self._path(kind).read_text())
+
+    def mark_sent(self, kind: str, union_name: str):
+        with self._lock:
+            path = self._path(kind)
+            sent = json.loads(path.read_text())
+
+            if isinstance(sent, dict):
+                sent.setdefault(union_name, [])
+                sent[union_name].append(datetime.now(UTC).isoformat())
+            else:
+                sent.append(union_name)
+
+            _write_atomic(path, json.dumps(sent, indent=4).encode())
+
+
+class Outbox:
+    """
+    A spool folder with emails there is ready to be sent. Each email is stored as the full MIME message
+    (`<id>.eml`) and a JSON file with the receivers and which sent state to update when it is delivered
+    (`<id>.json`). The email is only queued when the JSON file exists, and it is only removed from the
+    outbox after the SMTP server have accepted it.
+    """
+    folder: Path
+
+    def __init__(self, folder: Path):
+        self.folder = Path(folder)
+        self.folder.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._sent_states: Dict[Path, SentState] = {}
+        # The retries of this run: message id -> (failed attempts, the earliest time of the next attempt)
+        self._retries: Dict[str, Tuple[int, float]] = {}
+        self.enqueued = threading.Event()
+
+    def add_sent_state(self, sent_state: SentState):
+        """Use this sent state for the emails there updates the sent state in its folder"""
+        self._sent_states[Path(sent_state.folder).resolve()] = sent_state
+
+    def _sent_state(self, folder: str) -> SentState:
+        path = Path(folder).resolve()
+        if path not in self._sent_states:
+            self._sent_states[path] = SentState(path)
+        return self._sent_states[path]
+
+    def enqueue(self, from_addr: str, to_addrs: List[str], msg: str, union_name: str,
+                sent_state: Optional[SentState] = None, sent_kind: Optional[str] = None) -> str:
+        """
+        :param sent_state: The sent state there is updated, when the email is delivered
+        :param sent_kind: The kind of email in the sent state (`status`, `last-status` or `invoice`)
+        Return: The id of the email in the outbox
+        """
+        message_id = "{}-{}".format(datetime.now(UTC).strftime("%Y%m%dT%H%M%S%f"), uuid.uuid4().hex[:12])
+        meta = {
+            "from_addr": from_addr,
+            "to_addrs": to_addrs,
+            "union_name": union_name,
+            "sent_state": str(Path(sent_state.folder).resolve()) if sent_state else None,
+            "sent_kind": sent_kind,
+            "created": datetime.now(UTC).isoformat(),
+            "attempts": 0,
+            "last_error": None,
+        }
+
+        if sent_state is not None:
+            self.add_sent_state(sent_state)
+
+        # The message have to be there before the metadata, because the metadata marks it as queued
+        _write_atomic(self.folder.joinpath(f"{message_id}.eml"), msg.encode())
+        _write_atomic(self.folder.joinpath(f"{message_id}.json"), json.dumps(meta, indent=4).encode())
+        self.enqueued.set()
+        return message_id
+
+    def messages(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Return: The id and the metadata of the queued emails, the oldest first"""
+        messages = []
+        for path in sorted(self.folder.glob("*.json")):
+            try:
+                messages.append((path.stem, json.loads(path.read_text())))
+            except (OSError, ValueError):
+                # It was delivered by another thread while looking through the folder
+                continue
+        return messages
+
+    def is_queued(self, sent_state: SentState, sent_kind: str, union_name: str) -> bool:
+        folder = str(Path(sent_state.folder).resolve())
+        return any(meta["sent_state"] == folder and meta["sent_kind"] == sent_kind and
+                   meta["union_name"] == union_name for _, meta in self.messages())
+
+    def discard(self, sent_state: SentState, sent_kind: str, union_name: str) -> int:
+        """
+        Remove the queued emails of the kind to the union, like an older status email there is replaced by a new one.
+        An email there is being delivered is not removed
+        Return: The number of emails there was removed
+        """
+        folder = str(Path(sent_state.folder).resolve())
+        with self._lock:
+            discarded = 0
+            for message_id, meta in self.messages():
+                if meta["sent_state"] == folder and meta["sent_kind"] == sent_kind and meta["union_name"] == union_name:
+                    # The metadata first, because it marks the email as queued
+                    self.folder.joinpath(f"{message_id}.json").unlink(missing_ok=True)
+                    self.folder.joinpath(f"{message_id}.eml").unlink(missing_ok=True)
+                    self._retries.pop(message_id, None)
+                    discarded += 1
+            return discarded
+
+    def _deliver(self, transport, message_id: str, meta: Dict[str, Any]) -> Optional[float]:
+        """Return: The number of seconds it took to send the email"""
+        msg = self.folder.joinpath(f"{message_id}.eml").read_text()
+        latency = transport.send(from_addr=meta["from_addr"], to_addrs=meta["to_addrs"], msg=msg)
+
+        if meta["sent_state"] is not None:
+            self._sent_state(meta["sent_state"]).mark_sent(meta["sent_kind"], meta["union_name"])
+
+        self.folder.joinpath(f"{message_id}.json").unlink()
+        self.folder.joinpath(f"{message_id}.eml").unlink(missing_ok=True)
+        return latency
+
+    def deliver_due(self, transport, max_attempts: int, debug: bool = False) -> Optional[float]:
+        """
+        Try to send the queued emails there is not waiting for a retry
+        :param transport: The `SMTPTransport` to send the emails with
+        :param max_attempts: The number of times an email is tried in this run, before it is left in the outbox
+        :param debug: Print how long it took to send each email
+        Return: The number of seconds until the next retry, or None if there are no more retries in this run
+        """
+        with self._lock:
+            next_retry = None
+            for message_id, meta in self.messages():
+                attempts, retry_at = self._retries.get(message_id, (0, 0.0))
+                if attempts >= max_attempts:
+                    continue
+
+                now = time.monotonic()
+                if retry_at > now:
+                    next_retry = min(next_retry if next_retry is not None else retry_at, retry_at)
+                    continue
+
+                try:
+                    latency = self._deliver(transport, message_id, meta)
+                    self._retries.pop(message_id, None)
+                    if debug:
+                        print(f"[DEBUG] The email to {meta['union_name']} was delivered in {latency:.3f} seconds")
+
+                except (smtplib.SMTPException, OSError) as e:
+                    attempts += 1
+                    meta["attempts"] += 1
+                    meta["last_error"] = repr(e)
+                    _write_atomic(self.folder.joinpath(f"{message_id}.json"), json.dumps(meta, indent=4).encode())
+
+                    retry_at = time.monotonic() + min(RETRY_DELAY * 2 ** (attempts - 1), RETRY_DELAY_MAX)
+                    self._retries[message_id] = (attempts, retry_at)
+                    print(f"The email to {meta['union_name']} could not be sent (attempt {attempts} of "
+                        f"{max_attempts}): {e}")
+
+                    if attempts < max_attempts:
+                        next_retry = min(next_retry if next_retry is not None else retry_at, retry_at)
+
+            return None if next_retry is None else max(next_retry - time.monotonic(), 0.0)
+
+    def flush(self, transport, max_attempts: int, debug: bool = False) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Send all the queued emails, and wait between the retries of the emails there fail
+        Return: The emails there is still in the outbox
+        """
+        while True:
+            delay = self.deliver_due(transport, max_attempts=max_attempts, debug=debug)
+            if delay is None:
+                return self.messages()
+            time.sleep(delay)
+
+
+class OutboxWorker(threading.Thread):
+    """Delivers the emails in the outbox in the background, while the reports for the unions are created"""
+    def __init__(self, outbox: Outbox, transport, max_attempts: int, debug: bool = False):
+        super().__init__(name="outbox", daemon=True)
+        self._outbox = outbox
+        self._transport = transport
+        self._max_attempts = max_attempts
+        self._debug = debug
+        self._closing = threading.Event()
+
+    def run(self):
+        while True:
+            # Read the flag before the delivery, so the emails queued before close() are always tried
+            closing = self._closing.is_set()
+            self._outbox.enqueued.clear()
+            try:
+                delay = self._outbox.deliver_due(self._transport, max_attempts=self._max_attempts, debug=self._debug)
+            except Exception:
+                # The worker have to keep running, otherwise the emails pile up in the outbox without any error
+                print("ERROR: The emails in the outbox could not be sent, they are tried again later", file=sys.stderr)
+                traceback.print_exc()
+                delay = RETRY_DELAY
+            if closing:
+                return
+            self._outbox.enqueued.wait(timeout=delay)
+
+    def close(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Try to send the emails there is queued, without waiting for retries
+        Return: The emails there is still in the outbox
+        """
+        self._closing.set()
+        self._outbox.enqueued.set()
+        self.join()
+        return self._outbox.messages()
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.outbox = Outbox(Path(folder.name, "outbox"))
+        self.sent_state = SentState(Path(folder.name))
+
+    def test_10_discard(self):
+        self.outbox.enqueue("a@example.com", ["b@example.com"], "1", "Union1", self.sent_state, "status")
+        self.outbox.enqueue("a@example.com", ["b@example.com"], "2", "Union2", self.sent_state, "status")
+        self.outbox.enqueue("a@example.com", ["b@example.com"], "3", "Union1", self.sent_state, "invoice")
+
+        self.assertEqual(self.outbox.discard(self.sent_state, "status", "Union1"), 1)
+        self.assertFalse(self.outbox.is_queued(self.sent_state, "status", "Union1"))
+        self.assertEqual([(meta["union_name"], meta["sent_kind"]) for _, meta in self.outbox.messages()],
+                         [("Union2", "status"), ("Union1", "invoice")])
+        self.assertEqual(len(list(self.outbox.folder.iterdir())), 4)
+
+
+    def test_20_worker_keeps_running(self):
+        from unittest import mock
+
+        class Transport:
+            def __init__(self):
+                self.messages = []
+                self.called = threading.Event()
+
+            def send(self, from_addr: str, to_addrs: List[str], msg: str) -> float:
+                self.called.set()
+                if not self.messages:
+                    self.messages.append(None)
+                    raise ValueError("Not an SMTP error")
+                self.messages.append(msg)
+                return 0.0
+
+        transport = Transport()
+        worker = OutboxWorker(self.outbox, transport, max_attempts=5)
+        worker.start()
+        with mock.patch("sys.stderr", new=io.StringIO()) as stderr:
+            self.outbox.enqueue("a@example.com", ["b@example.com"], "1", "Union1", self.sent_state, "status")
+            self.assertTrue(transport.called.wait(timeout=10))
+            self.assertEqual(worker.close(), [])
+
+        self.assertEqual(transport.messages, [None, "1"])
+        self.assertIn("ValueError: Not an SMTP error", stderr.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor, Future, ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from subprocess import Popen, PIPE
+from typing import Dict, List, Sequence, Tuple
+from unittest import mock
+
+
+BIN_HTML_TO_PDF = "wkhtmltopdf"
+
+
+class PdfRenderError(Exception):
+    exit_code: int
+    stdout: bytes
+    stderr: bytes
+
+    def __init__(self, exit_code: int, stdout: bytes, stderr: bytes):
+        super().__init__(f"{BIN_HTML_TO_PDF} failed with the exit code {exit_code}")
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class PdfRenderer:
+    """
+    Renders HTML documents to PDF with `wkhtmltopdf`, with a number of workers there is started once per run.
+
+    It is the start of WebKit there takes most of the time of a `wkhtmltopdf` process, and not the rendering
+    of the small invoices. So each worker keeps a `wkhtmltopdf` process started and waiting for the HTML on
+    stdin, with the same options as the last document. The next document with the same options is then piped
+    into a process there is already started, while a new process is started in the background for the one
+    after that. The PDF is read from stdout, so nothing is written to disk.
+
+    The waiting processes have to be stopped with `stop_warm` before a process is forked (like the workers of the
+    spreadsheets), otherwise the forked process keeps their stdin open, and they never get the end of the HTML.
+    """
+    workers: int
+
+    def __init__(self, workers: int = 1):
+        self.workers = max(workers, 1)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pdf-renderer")
+        self._lock = threading.Lock()
+        self._closed = False
+        # The processes there is started and waiting for a document, by the options they were started with
+        self._warm: Dict[Tuple[str, ...], List[Popen]] = {}
+
+    def __enter__(self) -> "PdfRenderer":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _start(options: Tuple[str, ...]) -> Popen:
+        # The process only gets its own pipes, and not the stdin of the other waiting processes
+        return Popen([BIN_HTML_TO_PDF, '--quiet', *options, '-', '-'], stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                     close_fds=True, pass_fds=())
+
+    def _process(self, options: Tuple[str, ...]) -> Popen:
+        """Return: A started process for the options, and start another one for the next document"""
+        with self._lock:
+            warm = self._warm.setdefault(options, [])
+            process = warm.pop() if warm else None
+            if not self._closed and len(warm) < self.workers:
+                warm.append(self._start(options))
+
+        return process if process is not None else self._start(options)
+
+    def _render(self, html_text: str, options: Tuple[str, ...]) -> bytes:
+        process = self._process(options)
+        stdout, stderr = process.communicate(input=html_text.encode())
+
+        if process.returncode != 0:
+            raise PdfRenderError(exit_code=process.returncode, stdout=stdout, stderr=stderr)
+        return stdout
+
+    def submit(self, html_text: str, options: Sequence[str] = ()) -> "Future[bytes]":
+        """
+        :param html_text: The HTML document
+        :param options: The options for `wkhtmltopdf`, like `('--title', 'Faktura')`
+        Return: A future with the PDF, it raises `PdfRenderError` if `wkhtmltopdf` failed
+        """
+        return self._executor.submit(self._render, html_text, tuple(options))
+
+    def render(self, html_text: str, options: Sequence[str] = ()) -> bytes:
+        return self.submit(html_text, options).result()
+
+    def stop_warm(self):
+        """Stop the processes there is waiting for a document, they are started again by the next document"""
+        with self._lock:
+            warm = [process for processes in self._warm.values() for process in processes]
+            self._warm.clear()
+
+        for process in warm:
+            process.kill()
+            process.communicate()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+        with self._lock:
+            self._closed = True
+        self.stop_warm()
+
+
+class TestPdfRenderer(unittest.TestCase):
+    def setUp(self):
+        # A `wkhtmltopdf` there returns the HTML as the PDF
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        program = Path(folder.name).joinpath(BIN_HTML_TO_PDF)
+        program.write_text("#!/bin/sh\nexec cat\n")
+        program.chmod(0o700)
+        patcher = mock.patch(f"{__name__}.BIN_HTML_TO_PDF", str(program))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_10_two_scheduled_runs(self):
+        from ..scheduler import Scheduler
+
+        class Now:
+            @staticmethod
+            def next_time(after: datetime) -> datetime:
+                return after
+
+        renderer = PdfRenderer(workers=2)
+        self.addCleanup(renderer.close)
+        # If a run hangs, the processes are killed, so the renderer can be closed
+        processes = []
+        start = PdfRenderer._start
+
+        def start_and_remember(options: Tuple[str, ...]) -> Popen:
+            processes.append(start(options))
+            return processes[-1]
+
+        patcher = mock.patch.object(PdfRenderer, "_start", staticmethod(start_and_remember))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: [process.kill() for process in processes])
+        pdfs = []
+        runs = []
+
+        def run():
+            runs.append(True)
+            try:
+                # Like a run with --jobs, the workers of the spreadsheets are forked before the invoices are rendered
+                with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("fork")) as pool:
+                    pool.submit(int).result()
+                    pdfs.append(renderer.submit(f"<p>{len(pdfs)}</p>").result(timeout=10))
+                renderer.stop_warm()
+            finally:
+                if len(runs) == 2:
+                    os.kill(os.getpid(), signal.SIGTERM)
+
+        Scheduler(Now(), job=run, reload=Now).run()
+        self.assertEqual(pdfs, [b"<p>0</p>", b"<p>1</p>"])
+
+
+if __name__ == '__main__':
+    unittest.main()
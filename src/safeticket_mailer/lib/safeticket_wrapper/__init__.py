@@ -1,17 +1,49 @@
 #!/usr/bin/env python3
 # ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
-import pickle
+import codecs
+import fcntl
+import gzip
+import hashlib
+import json
+import os
 import unittest
-from datetime import datetime, timedelta
+from contextlib import contextmanager, nullcontext
+from email.message import Message
+from itertools import chain
 from pathlib import Path
 from time import time
-from typing import Dict, Any, List
-from urllib.parse import urljoin
+from typing import Callable, Dict, Any, List, Iterable, Iterator, Optional
+from urllib.parse import urljoin, urlparse
 
 import requests
+import urllib3
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.util.retry import Retry
 import atexit
 
 
+# The (connect, read) timeouts in seconds, the read timeout is the longest time to wait between two bytes
+CONNECT_TIMEOUT = 3.05
+DEFAULT_TIMEOUT = (CONNECT_TIMEOUT, 10)
+ENDPOINT_TIMEOUTS = {
+    # SafeTicket can take a long time to start sending the export of a big event
+    "/admin/eventexportcsv": (CONNECT_TIMEOUT, 120),
+}
+
+# A failed request is retried after 0.5, 1 and 2 seconds (plus up to 0.5 seconds of jitter)
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+BACKOFF_JITTER = 0.5
+RETRY_STATUSES = (429, 502, 503, 504)
+# The POST requests there only reads from SafeTicket, so they are safe to retry
+IDEMPOTENT_POSTS = {"/admin/eventexportcsv"}
+
+# SafeTicket is only used from one thread, but a login can happen while a streamed export is still open
+POOL_MAXSIZE = 4
+
+
 class Event:
     created_email: str
     created_name: str
@@ -104,21 +136,371 @@ class LoginError(BaseException):
         self.errors = 403
 
 
+def iter_decoded_lines(chunks: Iterable[bytes], encoding: str) -> Iterator[str]:
+    """
+    Decode the chunks of bytes incrementally and yield them line by line (with the line endings kept),
+    so a multibyte character or a line split across two chunks is put together again.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+
+    pending = ""
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def get_response_encoding(resp: requests.Response, head: bytes, default: str) -> str:
+    """
+    Find the encoding of a response without guessing it from the body. The charset in the
+    Content-Type header is used if the server sends one, then the byte order mark (BOM) in the start
+    of the body, and if there is none of them, the configured default encoding is used.
+    :param resp: The response, only the headers are used
+    :param head: The first bytes of the body
+    :param default: The encoding to use, if neither the header nor the BOM tells the encoding
+    """
+    message = Message()
+    message['content-type'] = resp.headers.get('content-type', '')
+    charset = message.get_content_charset()
+    if charset:
+        try:
+            codecs.lookup(charset)
+            return charset
+        except LookupError:
+            pass
+
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+
+    return default
+
+
+def print_decoding_time(sample: bytes, encoding: str):
+    """Print how long it takes to decode the sample with the known encoding compared to guessing the encoding"""
+    start_time = time()
+    sample.decode(encoding, errors='replace')
+    decode_time = time() - start_time
+
+    print("[DEBUG] Decoding {} bytes as '{}': {:.2f} ms".format(len(sample), encoding, decode_time * 1000))
+
+    # Requests uses this module to guess the charset, when the server doesn't tell it
+    if requests.compat.chardet is not None:
+        start_time = time()
+        requests.compat.chardet.detect(sample)
+        print("[DEBUG] Guessing the charset of the same bytes would take: {:.2f} ms".format(
+            (time() - start_time) * 1000))
+
+
+class SessionStore:
+    """
+    The cookies of the login to SafeTicket, stored in a JSON file (in the data folder), so the runs
+    share the login. The file is locked while the login is checked and renewed, so when more runs
+    are started at the same time, only one of them logs in and the others use its cookies.
+    """
+    path: Path
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with open(self.path.with_suffix(".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self, cookies: requests.cookies.RequestsCookieJar, account: str) -> bool:
+        """
+        Add the stored cookies to the cookie jar, if they are for the account and haven't expired
+        Return: True if there were cookies to add
+        """
+        try:
+            stored = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return False
+
+        if stored.get("account") != account or not stored.get("cookies"):
+            return False
+
+        # The server tells when the cookies expire, the session cookies (without an expiry) are checked with a request
+        expires = stored.get("expires")
+        if expires is not None and expires <= time():
+            return False
+
+        for cookie in stored["cookies"]:
+            cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"],
+                        expires=cookie["expires"], secure=cookie["secure"])
+        return True
+
+    def save(self, cookies: requests.cookies.RequestsCookieJar, account: str):
+        stored_cookies = [
+            {"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path,
+             "expires": cookie.expires, "secure": cookie.secure}
+            for cookie in cookies
+        ]
+        stored = {
+            "account": account,
+            "cookies": stored_cookies,
+            "expires": min((cookie["expires"] for cookie in stored_cookies if cookie["expires"] is not None),
+                           default=None),
+        }
+
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.touch(mode=0o600)
+        tmp_path.write_text(json.dumps(stored, indent=4))
+        os.replace(tmp_path, self.path)
+
+
+class RequestStats:
+    """
+    How many requests there was sent to SafeTicket, and how long time there was waited for the responses
+    (until the headers were received). The body of the CSV export is counted in `received_bytes`
+    and `receive_time`, because it is read after that.
+    """
+    requests: int
+    retries: int
+    timeouts: int
+    wait_time: float
+    received_bytes: int
+    receive_time: float
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.received_bytes = 0
+        self.receive_time = 0.0
+
+
+class CountingRetry(Retry):
+    """A `Retry` there counts the retries and the timeouts in the stats"""
+    stats: Optional[RequestStats] = None
+
+    def new(self, **kw) -> "CountingRetry":
+        retry = super(CountingRetry, self).new(**kw)
+        retry.stats = self.stats
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if self.stats is not None and isinstance(error, urllib3.exceptions.TimeoutError):
+            self.stats.timeouts += 1
+
+        # Raises an error, if the request can't be retried
+        retry = super(CountingRetry, self).increment(method, url, response, error, _pool, _stacktrace)
+        if self.stats is not None:
+            self.stats.retries += 1
+        return retry
+
+
+def recording_name(request: requests.PreparedRequest) -> str:
+    """
+    Return: The name of the files of the recorded response to the request. The host is not a part of it, so the
+    recordings can be replayed against any server, and the body is only a part of it as a hash (it has the password
+    when logging in)
+    """
+    url = urlparse(request.url)
+    body = request.body if request.body is not None else b""
+    body = body.encode("utf-8") if isinstance(body, str) else body
+
+    digest = hashlib.sha256(f"{request.method} {url.path}?{url.query}\n".encode("utf-8") + body).hexdigest()
+    return "{}{}-{}".format(request.method, url.path.replace("/", "_").rstrip("_"), digest[:16])
+
+
+# These headers are not recorded: the body is stored decoded, and the cookies of the login are not stored
+SKIPPED_RECORDING_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "set-cookie"}
+
+
+class _RecordingBody:
+    """The body of a response, there is written to the recording while it is read"""
+
+    def __init__(self, raw: urllib3.HTTPResponse, path: Path):
+        self._raw = raw
+        self._path = path
+        self._tmp_path = path.with_name(f".{path.name}.tmp")
+        self._file = gzip.open(self._tmp_path, "wb")
+
+    def __getattr__(self, name: str):
+        return getattr(self._raw, name)
+
+    def _done(self):
+        # Only a body there is read to the end is recorded
+        if not self._file.closed:
+            self._file.close()
+            os.replace(self._tmp_path, self._path)
+
+    def stream(self, amt: int = 2 ** 16, decode_content: Optional[bool] = None) -> Iterator[bytes]:
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            self._file.write(chunk)
+            yield chunk
+        self._done()
+
+    def read(self, amt: Optional[int] = None, *args, **kwargs) -> bytes:
+        data = self._raw.read(amt, *args, **kwargs)
+        self._file.write(data)
+        if amt is None or not data:
+            self._done()
+        return data
+
+    def close(self):
+        self._raw.close()
+        if not self._file.closed:
+            self._file.close()
+            self._tmp_path.unlink(missing_ok=True)
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Sends the requests like the `HTTPAdapter`, and writes each response to the folder: the status and the headers
+    to `{name}.json` and the body to `{name}.body.gz`, while the body is read
+    """
+    folder: Path
+
+    def __init__(self, folder: Path, *args, **kwargs):
+        super(RecordingAdapter, self).__init__(*args, **kwargs)
+        self.folder = Path(folder)
+        self.folder.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+    def send(self, request: requests.PreparedRequest, *args, **kwargs) -> requests.Response:
+        resp = super(RecordingAdapter, self).send(request, *args, **kwargs)
+
+        name = recording_name(request)
+        self.folder.joinpath(f"{name}.json").write_text(json.dumps({
+            "method": request.method,
+            "url": urlparse(request.url)._replace(scheme="", netloc="").geturl(),
+            "status_code": resp.status_code,
+            "reason": resp.reason,
+            "headers": {key: value for key, value in resp.headers.items()
+                        if key.lower() not in SKIPPED_RECORDING_HEADERS},
+        }, indent=4))
+        resp.raw = _RecordingBody(resp.raw, self.folder.joinpath(f"{name}.body.gz"))
+        return resp
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answers the requests with the responses recorded by the `RecordingAdapter`, without using the network"""
+    folder: Path
+
+    def __init__(self, folder: Path):
+        super(ReplayAdapter, self).__init__()
+        self.folder = Path(folder)
+
+    def send(self, request: requests.PreparedRequest, stream=False, timeout=None, verify=True, cert=None,
+             proxies=None) -> requests.Response:
+        name = recording_name(request)
+        try:
+            recording = json.loads(self.folder.joinpath(f"{name}.json").read_text())
+            body = gzip.open(self.folder.joinpath(f"{name}.body.gz"), "rb")
+        except FileNotFoundError:
+            raise requests.exceptions.ConnectionError(
+                f"There is no recording of {request.method} {request.url} in {self.folder}", request=request)
+
+        resp = requests.Response()
+        resp.status_code = recording["status_code"]
+        resp.reason = recording["reason"]
+        resp.headers = CaseInsensitiveDict(recording["headers"])
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp.raw = body
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        return resp
+
+    def close(self):
+        pass
+
+
 class Client(requests.Session):
-    def __init__(self, organization: str, *args, **kwargs):
+    stats: RequestStats
+    replay_folder: Optional[Path]
+
+    def __init__(self, organization: str, *args, base_url: Optional[str] = None,
+                 record_folder: Optional[Path] = None, replay_folder: Optional[Path] = None, **kwargs):
+        """
+        :param base_url: Use another server than the one of the organization on safeticket.dk
+        :param record_folder: Write all the responses to the folder
+        :param replay_folder: Answer the requests with the responses in the folder, instead of sending them
+        """
         # noinspection PyArgumentList
         super(Client, self).__init__(*args, **kwargs)
 
-        self.prefix_url = f"https://{organization}.safeticket.dk"
+        self.prefix_url = base_url if base_url else f"https://{organization}.safeticket.dk"
+        # Called when a request gets a 403, it returns True if it logged in again, and the request is then retried
+        self.relogin: Optional[Callable[[], bool]] = None
+        self.stats = RequestStats()
+        self.replay_folder = replay_folder
+        self._record_folder = record_folder
+
+        if replay_folder is not None:
+            adapter = ReplayAdapter(replay_folder)
+            self.mount("https://", adapter)
+            self.mount("http://", adapter)
+            self._endpoint_adapters = {}
+            return
+
+        # Only the idempotent requests are retried, when the server fails or doesn't answer in time
+        adapter = self._adapter(Retry.DEFAULT_ALLOWED_METHODS)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self._endpoint_adapters = {path: self._adapter(Retry.DEFAULT_ALLOWED_METHODS | {"POST"})
+                                   for path in IDEMPOTENT_POSTS}
+
+    def _adapter(self, allowed_methods: Iterable[str]) -> HTTPAdapter:
+        retry = CountingRetry(total=MAX_RETRIES, allowed_methods=allowed_methods, status_forcelist=RETRY_STATUSES,
+                              backoff_factor=BACKOFF_FACTOR, backoff_jitter=BACKOFF_JITTER, raise_on_status=False)
+        retry.stats = self.stats
+        # All the requests are sent to the same host
+        if self._record_folder is not None:
+            return RecordingAdapter(self._record_folder, pool_connections=1, pool_maxsize=POOL_MAXSIZE,
+                                    max_retries=retry)
+        return HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+
+    def get_adapter(self, url: str) -> HTTPAdapter:
+        adapter = self._endpoint_adapters.get(urlparse(url).path)
+        return adapter if adapter is not None else super(Client, self).get_adapter(url)
+
+    def close(self):
+        super(Client, self).close()
+        for adapter in self._endpoint_adapters.values():
+            adapter.close()
+
+    def _send(self, method, url, *args, **kwargs) -> requests.Response:
+        start_time = time()
+        try:
+            return super(Client, self).request(method, url, *args, **kwargs)
+        finally:
+            self.stats.requests += 1
+            self.stats.wait_time += time() - start_time
 
     def request(self, method, url, *args, **kwargs):
         url = urljoin(self.prefix_url, url)
+        kwargs.setdefault("timeout", ENDPOINT_TIMEOUTS.get(urlparse(url).path, DEFAULT_TIMEOUT))
 
-        start_time = time()
-        resp = super(Client, self).request(
-            method, url, *args, timeout=5, **kwargs
-        )
-        print("[DEBUG] Response time: {:.2f} secs".format(time() - start_time))
+        resp = self._send(method, url, *args, **kwargs)
+
+        # The login have expired on the server, so log in again and retry the request once
+        if resp.status_code == 403 and self.relogin is not None:
+            relogin, self.relogin = self.relogin, None
+            try:
+                if relogin():
+                    resp.close()
+                    resp = self._send(method, url, *args, **kwargs)
+            finally:
+                self.relogin = relogin
 
         return resp
 
@@ -127,47 +509,88 @@ class SafeTicket:
     _username = None
     _password = None
     _session = None
-
-    def __init__(self, organization: str, username: str, password: str):
+    _encoding = None
+    _debug = False
+
+    def __init__(self, organization: str, username: str, password: str,
+                 encoding: str = 'utf-8', debug: bool = False, session_store: Optional[SessionStore] = None,
+                 base_url: Optional[str] = None, record_folder: Optional[Path] = None,
+                 replay_folder: Optional[Path] = None):
+        """
+        :param encoding: The encoding of the responses from SafeTicket, used if the server doesn't tell it
+        :param debug: Print timing information about the decoding of the responses
+        :param session_store: Where the login is stored between the runs, the login is only kept in memory if it is None
+        :param base_url: Use another server than https://{organization}.safeticket.dk
+        :param record_folder: Write all the responses from SafeTicket to the folder
+        :param replay_folder: Use the responses recorded in the folder, instead of SafeTicket
+        """
         self._username = username
         self._password = password
-        self._session = Client(organization)
+        self._account = f"{username}@{base_url or organization}"
+        self._session = Client(organization, base_url=base_url, record_folder=record_folder,
+                               replay_folder=replay_folder)
+        self._session.relogin = self.login
+        self._encoding = encoding
+        self._debug = debug
+        self._session_store = session_store
         atexit.register(self._cleanup)
 
     def _cleanup(self):
         self._session.close()
 
-    def login(self) -> bool:
-        """Return: True, if successful and False if failed"""
-        cookie_path = Path("/tmp/.safeticket_mailer/cookie.jar")
+    @property
+    def stats(self) -> RequestStats:
+        """The number of requests, retries and timeouts, and the time there was waited for SafeTicket"""
+        return self._session.stats
 
-        dt = datetime.now() - timedelta(minutes=10)
-        if cookie_path.is_file() and cookie_path.stat().st_mtime > dt.timestamp():
-            with open(cookie_path, "rb") as f:
-                self._session.cookies.update(pickle.load(f))
-            return True
+    def _is_logged_in(self) -> bool:
+        """Return: True if the server still accepts the cookies, the body of the page is not downloaded"""
+        with self._session.get(url='/admin/', allow_redirects=False, stream=True) as req:
+            return req.status_code == 200
 
-        else:
-            req = self._session.post(
-                url='/admin/login',
-                data={
-                    'conturl': '/admin/',
-                    'email': self._username,
-                    'password': self._password
-                },
-                allow_redirects=False,
-            )
+    def _post_login(self) -> bool:
+        self._session.cookies.clear()
+        req = self._session.post(
+            url='/admin/login',
+            data={
+                'conturl': '/admin/',
+                'email': self._username,
+                'password': self._password
+            },
+            allow_redirects=False,
+        )
 
         # The page always return 200, but if there is a redirect (302) in the history
         # the login was a success, if not it failed
-        if req.status_code == 302:
-            cookie_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
-            with open(cookie_path, "wb") as f:
-                pickle.dump(self._session.cookies, f)
+        if req.status_code != 302:
+            return False
 
+        if self._session_store is not None:
+            self._session_store.save(self._session.cookies, self._account)
+        return True
+
+    def login(self) -> bool:
+        """
+        Use the stored login, if the server still accepts it, otherwise log in again
+        Return: True, if successful and False if failed
+        """
+        # The recorded responses are used without a login, so it doesn't matter how the recording logged in
+        if self._session.replay_folder is not None:
             return True
-        else:
-            return False
+
+        # A 403 while logging in must not log in again, it would wait for the lock there is already held
+        relogin, self._session.relogin = self._session.relogin, None
+        try:
+            with self._session_store.lock() if self._session_store is not None else nullcontext():
+                # Another run may have logged in again, since this session last used the stored cookies
+                if self._session_store is not None:
+                    self._session_store.load(self._session.cookies, self._account)
+
+                if self._session.cookies and self._is_logged_in():
+                    return True
+                return self._post_login()
+        finally:
+            self._session.relogin = relogin
 
     def get_events(self, past: bool = False) -> EventsResult:
         req = self._session.get(
@@ -182,7 +605,7 @@ class SafeTicket:
         if req.status_code == 403:
             raise LoginError()
 
-        return EventsResult(req.json())
+        return EventsResult(self._decode_json(req))
 
     def get_event_tickets(self, event_id: int) -> TicketsResult:
         req = self._session.get(
@@ -199,9 +622,15 @@ class SafeTicket:
         if req.status_code == 500:
             raise IndexError("Error: status_code is '500', "
                              "this normally happens because of an invalid event_id")
-        return TicketsResult(req.json())
+        return TicketsResult(self._decode_json(req))
 
-    def export_tickets_stats(self, event_id: int, ticket_ids: list) -> str:
+    def _decode_json(self, req: requests.Response) -> Any:
+        """Decode the JSON in the body with the same encoding rules as the export, see `get_response_encoding`"""
+        content = req.content
+        return json.loads(content.decode(get_response_encoding(req, content[:4], self._encoding), errors='replace'))
+
+    @staticmethod
+    def _export_tickets_stats_data(event_id: int, ticket_ids: list) -> Dict[str, Any]:
         _data = {
             'submitted': 1,
             'id': event_id,
@@ -211,9 +640,12 @@ class SafeTicket:
         for ticket_id in ticket_ids:
             _data['ticket{}'.format(ticket_id)] = 1
 
+        return _data
+
+    def export_tickets_stats(self, event_id: int, ticket_ids: list) -> str:
         req = self._session.post(
             url='/admin/eventexportcsv',
-            data=_data)
+            data=self._export_tickets_stats_data(event_id, ticket_ids))
 
         if req.status_code == 403:
             raise LoginError()
@@ -222,7 +654,129 @@ class SafeTicket:
             raise IndexError("Error: status_code is '500', "
                              "this normally happens because of an invalid event_id")
 
-        return req.text
+        start_time = time()
+        content = req.content
+        self.stats.receive_time += time() - start_time
+        self.stats.received_bytes += len(content)
+
+        encoding = get_response_encoding(req, content[:4], self._encoding)
+        if self._debug:
+            print_decoding_time(content, encoding)
+
+        return content.decode(encoding, errors='replace')
+
+    def _count_received(self, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        """Count the bytes and the time it takes to receive them in the stats"""
+        while True:
+            start_time = time()
+            chunk = next(chunks, None)
+            self.stats.receive_time += time() - start_time
+            if chunk is None:
+                return
+            self.stats.received_bytes += len(chunk)
+            yield chunk
+
+    def stream_tickets_stats(self, event_id: int, ticket_ids: list, chunk_size: int = 64 * 1024) -> Iterator[str]:
+        """
+        The same as `export_tickets_stats`, but the CSV file is read from the connection and decoded
+        in chunks and yielded line by line, so the whole export never have to be in memory at once.
+        """
+        with self._session.post(
+                url='/admin/eventexportcsv',
+                data=self._export_tickets_stats_data(event_id, ticket_ids),
+                stream=True) as req:
+
+            if req.status_code == 403:
+                raise LoginError()
+
+            if req.status_code == 500:
+                raise IndexError("Error: status_code is '500', "
+                                 "this normally happens because of an invalid event_id")
+
+            chunks = self._count_received(req.iter_content(chunk_size=chunk_size))
+            first_chunk = next(chunks, b"")
+            encoding = get_response_encoding(req, first_chunk, self._encoding)
+            if self._debug:
+                print_decoding_time(first_chunk, encoding)
+
+            yield from iter_decoded_lines(chain([first_chunk], chunks), encoding)
+
+
+class TestLogin(unittest.TestCase):
+    def test_10_login_forbidden(self):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        import tempfile
+        import threading
+
+        class Forbidden(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(403)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        server = HTTPServer(("127.0.0.1", 0), Forbidden)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+
+        safeticket = SafeTicket("test", "tester_username", "Tester_password_1212",
+                                session_store=SessionStore(Path(folder.name).joinpath("session.json")),
+                                base_url=f"http://127.0.0.1:{server.server_address[1]}")
+        result = []
+        thread = threading.Thread(target=lambda: result.append(safeticket.login()), daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+
+        self.assertFalse(thread.is_alive(), "The login waits for its own lock")
+        self.assertEqual(result, [False])
+        self.assertIsNotNone(safeticket._session.relogin)
+
+
+class TestEncoding(unittest.TestCase):
+    def test_10_json_not_utf_8(self):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        import threading
+
+        body = json.dumps({"status": "OK", "data": {"name": "Sommerfest på Ærø", "tickets": [
+            {"id": 1, "name": "Voksen – 50%"}]}}, ensure_ascii=False)
+
+        class Financial(BaseHTTPRequestHandler):
+            content_type = "application/json"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                content = body.encode("cp1252")
+                self.send_response(200)
+                self.send_header("Content-Type", self.content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        server = HTTPServer(("127.0.0.1", 0), Financial)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        # The configured encoding is used, when the server doesn't tell the charset
+        tickets = SafeTicket("test", "tester_username", "Tester_password_1212", encoding="cp1252",
+                             base_url=base_url).get_event_tickets(1)
+        self.assertEqual(tickets.data.name, "Sommerfest på Ærø")
+        self.assertEqual(tickets.data.tickets[0].name, "Voksen – 50%")
+
+        # The charset from the server is used before the configured encoding
+        Financial.content_type = "application/json; charset=windows-1252"
+        tickets = SafeTicket("test", "tester_username", "Tester_password_1212", encoding="utf-8",
+                             base_url=base_url).get_event_tickets(1)
+        self.assertEqual(tickets.data.tickets[0].name, "Voksen – 50%")
 
 
 class TestStringMethods(unittest.TestCase):
@@ -286,3 +840,16 @@ class TestStringMethods(unittest.TestCase):
     def test_42_export_tickets_stats__invalid_event(self):
         self._safeticket.login()
         self.assertRaises(IndexError, self._safeticket.get_event_tickets, 404)
+
+    def test_43_stream_tickets_stats(self):
+        self._safeticket.login()
+
+        r = self._safeticket.get_events()
+        event_ids = [e.id for e in r.data.events]
+
+        e = self._safeticket.get_event_tickets(event_ids[0])
+
+        ticket_ids = [t.id for t in e.data.tickets]
+        self.assertEqual(
+            ''.join(self._safeticket.stream_tickets_stats(event_ids[0], ticket_ids, chunk_size=7)),
+            self._safeticket.export_tickets_stats(event_ids[0], ticket_ids))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
+import signal
+import threading
+import traceback
+import unittest
+from datetime import datetime, timedelta
+from typing import Callable, Dict, FrozenSet, Optional
+
+
+MONTH_NAMES = {name: number for number, name in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], start=1)}
+WEEKDAY_NAMES = {name: number for number, name in enumerate(["sun", "mon", "tue", "wed", "thu", "fri", "sat"])}
+
+# The longest time there is slept at a time, so a changed clock (or a suspend) is noticed
+MAX_SLEEP = 60
+
+
+def _parse_field(field: str, first: int, last: int, names: Optional[Dict[str, int]] = None) -> FrozenSet[int]:
+    """
+    Parse one field of a cron expression, like `*`, `1,15`, `1-5`, `*/15`, `mon-fri` or `9-17/2`
+    :param first: The first value of the field
+    :param last: The last value of the field
+    :param names: The names there can be used instead of the numbers, like `mon`
+    """
+    names = names or {}
+
+    def value(text: str) -> int:
+        number = names[text.lower()] if text.lower() in names else int(text)
+        if not first <= number <= last:
+            raise ValueError(f"The value {number} is not between {first} and {last}")
+        return number
+
+    values = set()
+    for part in field.split(","):
+        range_text, _, step_text = part.partition("/")
+        step = int(step_text) if step_text else 1
+        if step < 1:
+            raise ValueError(f"The step have to be at least 1: {part}")
+
+        if range_text == "*":
+            start, end = first, last
+        elif "-" in range_text:
+            start_text, end_text = range_text.split("-", 1)
+            start, end = value(start_text), value(end_text)
+        else:
+            start = value(range_text)
+            # `5/10` means from 5 to the end with a step of 10
+            end = last if step_text else start
+
+        if start > end:
+            raise ValueError(f"The range is backwards: {part}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronSchedule:
+    """
+    A schedule written as a cron expression with 5 fields: minute, hour, day of the month, month and
+    day of the week, like `0 7 * * mon` for every Monday at 07:00. Like cron, a day matches if either
+    the day of the month or the day of the week matches, when both of them are restricted.
+    """
+    expression: str
+    minutes: FrozenSet[int]
+    hours: FrozenSet[int]
+    days: FrozenSet[int]
+    months: FrozenSet[int]
+    weekdays: FrozenSet[int]
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"The cron expression have to have 5 fields, not {len(fields)}: {expression}")
+
+        self.expression = expression
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12, MONTH_NAMES)
+        # Both 0 and 7 is Sunday
+        self.weekdays = frozenset(weekday % 7 for weekday in _parse_field(fields[4], 0, 7, WEEKDAY_NAMES))
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def __repr__(self) -> str:
+        return f"CronSchedule({self.expression!r})"
+
+    def _is_day(self, time: datetime) -> bool:
+        day = time.day in self.days
+        # Python counts the weekdays from Monday, cron counts from Sunday
+        weekday = (time.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_time(self, after: datetime) -> datetime:
+        """Return: The first time in the schedule after the time"""
+        time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # The schedule repeats itself at least every 28 years (the leap years and the weekdays)
+        end = time + timedelta(days=366 * 28)
+        while time < end:
+            if time.month not in self.months:
+                time = (time.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._is_day(time):
+                time = (time + timedelta(days=1)).replace(hour=0, minute=0)
+            elif time.hour not in self.hours:
+                time = (time + timedelta(hours=1)).replace(minute=0)
+            elif time.minute not in self.minutes:
+                time += timedelta(minutes=1)
+            else:
+                return time
+        raise ValueError(f"The cron expression never happens: {self.expression}")
+
+
+class Scheduler:
+    """
+    Runs a job each time the schedule says so, until the process gets SIGTERM or SIGINT. If the process
+    gets one of them while the job is running, the job is done before it stops, a second one stops it at once.
+    A SIGHUP calls the reload function before the next job, it returns the schedule to use from then on.
+    A job there fails is printed, and the scheduler waits for the next time in the schedule.
+    """
+    schedule: CronSchedule
+
+    def __init__(self, schedule: CronSchedule, job: Callable[[], None], reload: Callable[[], CronSchedule]):
+        self.schedule = schedule
+        self._job = job
+        self._reload = reload
+        self._wake_up = threading.Event()
+        self._stopping = False
+        self._reloading = False
+
+    def _handle_stop(self, signum, frame):
+        if self._stopping:
+            raise KeyboardInterrupt()
+        print(f"============(Got {signal.Signals(signum).name}, stopping after the current run)============",
+              flush=True)
+        self._stopping = True
+        self._wake_up.set()
+
+    def _handle_reload(self, signum, frame):
+        self._reloading = True
+        self._wake_up.set()
+
+    def _wait_until(self, time: datetime):
+        """Sleep until the time, or until the process gets a signal"""
+        while not self._stopping and not self._reloading:
+            delay = (time - datetime.now()).total_seconds()
+            if delay <= 0:
+                return
+            self._wake_up.wait(min(delay, MAX_SLEEP))
+            self._wake_up.clear()
+
+    def run(self):
+        handlers = {
+            signal.SIGTERM: self._handle_stop,
+            signal.SIGINT: self._handle_stop,
+            signal.SIGHUP: self._handle_reload,
+        }
+        previous_handlers = {signum: signal.signal(signum, handler) for signum, handler in handlers.items()}
+        try:
+            while not self._stopping:
+                next_time = self.schedule.next_time(datetime.now())
+                print(f"============(The next run is at {next_time:%Y-%m-%d %H:%M})============", flush=True)
+                self._wait_until(next_time)
+
+                if self._stopping:
+                    break
+
+                if self._reloading:
+                    self._reloading = False
+                    print("============(Reloading the config)============", flush=True)
+                    try:
+                        self.schedule = self._reload()
+                    except Exception:
+                        print("The config could not be reloaded, the old config is still used:", flush=True)
+                        traceback.print_exc()
+                    continue
+
+                try:
+                    self._job()
+                except KeyboardInterrupt:
+                    raise
+                except BaseException:
+                    # `sys.exit` is used for the errors in a run, so it is also caught
+                    print("The run failed:", flush=True)
+                    traceback.print_exc()
+
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
+
+class TestCronSchedule(unittest.TestCase):
+    def test_10_every_monday(self):
+        schedule = CronSchedule("0 7 * * mon")
+        self.assertEqual(schedule.next_time(datetime(2024, 6, 5, 12, 0)), datetime(2024, 6, 10, 7, 0))
+        self.assertEqual(schedule.next_time(datetime(2024, 6, 10, 7, 0)), datetime(2024, 6, 17, 7, 0))
+
+    def test_20_steps_and_ranges(self):
+        schedule = CronSchedule("*/15 9-17/4 * * *")
+        self.assertEqual(schedule.next_time(datetime(2024, 6, 5, 9, 50)), datetime(2024, 6, 5, 13, 0))
+        self.assertEqual(schedule.next_time(datetime(2024, 6, 5, 17, 45)), datetime(2024, 6, 6, 9, 0))
+
+    def test_30_day_of_month_or_weekday(self):
+        # The 1st of the month or a Sunday
+        schedule = CronSchedule("30 6 1 * 0")
+        self.assertEqual(schedule.next_time(datetime(2024, 6, 1, 7, 0)), datetime(2024, 6, 2, 6, 30))
+        self.assertEqual(schedule.next_time(datetime(2024, 6, 30, 7, 0)), datetime(2024, 7, 1, 6, 30))
+
+    def test_40_leap_day(self):
+        self.assertEqual(CronSchedule("0 0 29 feb *").next_time(datetime(2025, 1, 1)), datetime(2028, 2, 29))
+
+    def test_50_invalid(self):
+        for expression in ["0 7 * *", "60 * * * *", "0 0 30 feb *", "5-1 * * * *", "* * * foo *"]:
+            with self.assertRaises(ValueError, msg=expression):
+                CronSchedule(expression).next_time(datetime(2024, 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, UTC
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, List, Any, Optional, Iterable, NamedTuple
+
+from ..ticket_table import TicketTable
+
+
+class SyncResult(NamedTuple):
+    new: int
+    changed: int
+    removed: int
+    # The ticket numbers there was more than once in the export, only the first row of them is stored
+    duplicates: List[str]
+
+
+class TicketStore:
+    """
+    A local copy of the exported tickets of one event, stored in the data folder.
+
+    The tickets are keyed by `Billetnummer`, the store also remembers the counters of the event
+    (`tickets_sold` and `turnover_total`) from the last sync, so a run can tell if anything have
+    been sold, refunded or changed since the last export.
+    """
+    _version = 2
+
+    folder: Path
+    event_id: int
+    table: TicketTable
+    tickets_sold: Optional[str]
+    turnover_total: Optional[str]
+    last_order_timestamp: Optional[str]
+    synced_at: Optional[datetime]
+
+    def __init__(self, folder: Path, event_id: int):
+        self.folder = Path(folder)
+        self.event_id = event_id
+
+        self.table = TicketTable(fieldnames=[])
+        self.tickets_sold = None
+        self.turnover_total = None
+        self.last_order_timestamp = None
+        self.synced_at = None
+
+    @property
+    def _meta_path(self) -> Path:
+        return self.folder.joinpath("meta.json")
+
+    @property
+    def _tickets_path(self) -> Path:
+        return self.folder.joinpath("tickets.json")
+
+    @property
+    def fieldnames(self) -> List[str]:
+        return self.table.fieldnames
+
+    def load(self, columns: List[str]) -> bool:
+        """
+        :param columns: The fields there have to be in the store
+        Return: True, if the store exists and passed the validation and False if it have to be re-exported
+        """
+        if not self._meta_path.is_file() or not self._tickets_path.is_file():
+            return False
+
+        try:
+            meta = json.loads(self._meta_path.read_text())
+            tickets_content = self._tickets_path.read_bytes()
+
+            if meta.get("version") != self._version or meta.get("event_id") != self.event_id:
+                return False
+
+            if meta.get("checksum") != sha256(tickets_content).hexdigest():
+                return False
+
+            table = TicketTable.from_json(json.loads(tickets_content))
+            if table.row_count != meta["count"] or not set(columns) <= table.columns.keys():
+                return False
+
+            # Every ticket have to be there exactly once
+            if len(table.columns["Billetnummer"].values) - 1 != table.row_count:
+                return False
+
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+
+        self.table = table
+        self.tickets_sold = meta["tickets_sold"]
+        self.turnover_total = meta["turnover_total"]
+        self.last_order_timestamp = meta["last_order_timestamp"]
+        self.synced_at = datetime.fromisoformat(meta["synced_at"])
+        return True
+
+    def is_up_to_date(self, tickets_sold: str, turnover_total: str, max_age: timedelta) -> bool:
+        """
+        :param max_age: The store is too old after this time, even if the counters are the same, because the
+        counters don't change when the buyer of a ticket is changed, or a ticket is refunded and another is sold
+        Return: True, if the counters of the event are the same as at the last sync, and the store is not too old
+        """
+        if self.synced_at is None or self.synced_at + max_age < datetime.now(UTC):
+            return False
+
+        return self.tickets_sold == tickets_sold and self.turnover_total == turnover_total
+
+    def merge(self, fieldnames: List[str], columns: List[str], rows: Iterable[Dict[str, Any]],
+              tickets_sold: str, turnover_total: str) -> SyncResult:
+        """
+        Merge a fresh export into the store. The export is the source of the truth, so tickets
+        there is not in it anymore (refunded or cancelled) are removed from the store.
+        :param fieldnames: The header of the exported CSV file
+        :param columns: The fields there is stored, it have to include `Billetnummer` and `Billettype`
+        :param rows: The rows of the exported CSV file
+        :param tickets_sold: The `tickets_sold` counter from the event at the time of the export
+        :param turnover_total: The `turnover_total` counter from the event at the time of the export
+        """
+        old_table = self.table
+        old_ticket_numbers = old_table.columns.get("Billetnummer")
+        old_indices: Dict[str, int] = {}
+        if old_ticket_numbers is not None:
+            for index, code in enumerate(old_ticket_numbers.codes):
+                old_indices[old_ticket_numbers.values[code]] = index
+
+        new = changed = 0
+        seen = set()
+        duplicates = []
+        table = TicketTable(fieldnames=fieldnames, columns=columns)
+        for row in rows:
+            ticket_no = row["Billetnummer"]
+            if ticket_no in seen:
+                duplicates.append(ticket_no)
+                continue
+            seen.add(ticket_no)
+
+            old_index = old_indices.get(ticket_no)
+            if old_index is None:
+                new += 1
+            else:
+                old_row = old_table.row(old_index)
+                if any(old_row.get(column) != value for column, value in row.items()):
+                    changed += 1
+            table.append(row)
+
+        table.compact()
+        removed = len(old_indices.keys() - seen)
+
+        self.table = table
+        self.tickets_sold = tickets_sold
+        self.turnover_total = turnover_total
+        self.last_order_timestamp = None
+        if "Tidspunkt" in table.columns:
+            self.last_order_timestamp = max(filter(None, table.columns["Tidspunkt"].values[1:]), default=None)
+        self.synced_at = datetime.now(UTC)
+
+        return SyncResult(new=new, changed=changed, removed=removed, duplicates=duplicates)
+
+    def save(self):
+        self.folder.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+        tickets_content = json.dumps(self.table.to_json(), ensure_ascii=False).encode()
+        meta = {
+            "version": self._version,
+            "event_id": self.event_id,
+            "count": self.table.row_count,
+            "checksum": sha256(tickets_content).hexdigest(),
+            "tickets_sold": self.tickets_sold,
+            "turnover_total": self.turnover_total,
+            "last_order_timestamp": self.last_order_timestamp,
+            "synced_at": self.synced_at.isoformat(),
+        }
+
+        # Write to temporary files first, so a crash can't leave a half written store behind
+        for path, content in ((self._tickets_path, tickets_content),
+                              (self._meta_path, json.dumps(meta, indent=4).encode())):
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(content)
+            os.replace(tmp_path, path)
+
+
+class TestTicketStore(unittest.TestCase):
+    def test_10_reused_until_it_is_too_old(self):
+        fieldnames = ["Billetnummer", "Billettype", "Tidspunkt"]
+        rows = [{"Billetnummer": "1", "Billettype": "Voksen", "Tidspunkt": "2024-06-01T12:00:00"}]
+        with tempfile.TemporaryDirectory() as folder:
+            ticket_store = TicketStore(Path(folder), event_id=42)
+            ticket_store.merge(fieldnames, fieldnames, rows, tickets_sold="1", turnover_total="100")
+            ticket_store.save()
+            # A sync a week ago, like the weekly timer
+            ticket_store.synced_at -= timedelta(days=7)
+            ticket_store.save()
+
+            ticket_store = TicketStore(Path(folder), event_id=42)
+            self.assertTrue(ticket_store.load(columns=fieldnames))
+            self.assertTrue(ticket_store.is_up_to_date(tickets_sold="1", turnover_total="100",
+                                                       max_age=timedelta(days=14)))
+            self.assertFalse(ticket_store.is_up_to_date(tickets_sold="1", turnover_total="100",
+                                                        max_age=timedelta(hours=24)))
+            self.assertFalse(ticket_store.is_up_to_date(tickets_sold="2", turnover_total="200",
+                                                        max_age=timedelta(days=14)))
+
+    def test_20_duplicated_ticket_numbers(self):
+        fieldnames = ["Billetnummer", "Billettype", "Navn"]
+        rows = [{"Billetnummer": "1", "Billettype": "Voksen", "Navn": "A"},
+                {"Billetnummer": "1", "Billettype": "Voksen", "Navn": "B"},
+                {"Billetnummer": "2", "Billettype": "Voksen", "Navn": "C"}]
+        ticket_store = TicketStore(Path("unused"), event_id=42)
+        sync_result = ticket_store.merge(fieldnames, fieldnames, rows, tickets_sold="3", turnover_total="300")
+
+        self.assertEqual(sync_result, SyncResult(new=2, changed=0, removed=0, duplicates=["1"]))
+        self.assertEqual([row["Navn"] for row in ticket_store.table.rows], ["A", "C"])
+
+
+if __name__ == '__main__':
+    unittest.main()
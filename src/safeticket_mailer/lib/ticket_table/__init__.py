@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# ex: set tabstop=8 softtabstop=0 expandtab shiftwidth=2 smarttab:
+import re
+import unittest
+from array import array
+from collections.abc import Mapping, Sequence
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+from hashlib import sha256
+from typing import Dict, List, Any, Hashable, Iterator, Iterable, Optional, Tuple
+
+
+# The code used in a column for a row there doesn't have the field at all
+MISSING = 0
+
+DATETIME_PATTERN = re.compile(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}$")
+# The numbers with leading zeros (like the zip code `0800`) are kept as texts, so the zeros are not lost
+INT_PATTERN = re.compile(r"^(0|[1-9][0-9]*)$")
+# A whole price in the Danish format, like `1.234`, the dots only group the thousands
+GROUPED_INT_PATTERN = re.compile(r"^-?[1-9][0-9]{0,2}(\.[0-9]{3})+$")
+# A price in the Danish format, like `1.234,56`
+DECIMAL_PATTERN = re.compile(r"^-?[0-9]{1,3}(\.[0-9]{3})*,[0-9]+$|^-?[0-9]+,[0-9]+$")
+DISCOUNT_PATTERN = re.compile(r"(\d+) *%")
+# The values with more than one line, tabulate shows them over more lines
+MULTILINE_PATTERN = re.compile(r"[\r\n]")
+
+
+def parse_value(value: Any) -> Any:
+    """Return: The value as a `datetime`, `int` or `Decimal`, if it looks like one, otherwise the value itself"""
+    if not isinstance(value, str):
+        return value
+
+    if DATETIME_PATTERN.match(value):
+        return datetime.fromisoformat(value)
+    elif INT_PATTERN.match(value):
+        return int(value)
+    elif GROUPED_INT_PATTERN.match(value):
+        return int(value.replace('.', ''))
+    elif DECIMAL_PATTERN.match(value):
+        return Decimal(value.replace('.', '').replace(',', '.'))
+    return value
+
+
+@lru_cache(maxsize=None)
+def discount_percent(ticket_type_name: str) -> int:
+    """Return: The discount in the name of the ticket type, like `50` from `Medlem (50% rabat)`"""
+    match = DISCOUNT_PATTERN.search(ticket_type_name)
+    if match is None:
+        raise ValueError(f"The ticket type '{ticket_type_name}' doesn't have a discount in percent in the name")
+    return int(match.group(1))
+
+
+class Column:
+    """
+    One column of the ticket table. Every distinct value is only stored once (dictionary-encoded),
+    and each row only stores the code of its value, which is cheap, because most of the columns
+    (`Arrangement`, `Status`, `Betalingstype`, `Billettype`, `Pris`...) only have a few distinct values.
+
+    The typed value (`parse_value`) of each distinct value is stored next to it, so the values are only
+    converted once, and not each time they are written to a spreadsheet or used in the invoice.
+    """
+    values: List[Any]
+    typed_values: List[Any]
+    codes: array
+
+    def __init__(self):
+        self.values = [None]
+        self.typed_values = [None]
+        self._lookup: Optional[Dict[Hashable, int]] = {}
+        self.codes = array('I')
+
+    def encode(self, value: Hashable) -> int:
+        code = self.find(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.typed_values.append(parse_value(value))
+            self._lookup[value] = code
+        return code
+
+    def find(self, value: Hashable) -> Optional[int]:
+        """Return: The code of the value, or None if no rows have the value"""
+        if self._lookup is None:
+            self._lookup = {value: code for code, value in enumerate(self.values) if code != MISSING}
+        return self._lookup.get(value)
+
+    def append(self, value: Hashable):
+        self.codes.append(self.encode(value))
+
+    def append_missing(self):
+        self.codes.append(MISSING)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def compact(self):
+        """Drop the lookup table used while adding rows, it is rebuilt if more rows are added"""
+        self._lookup = None
+
+    def copy(self) -> "Column":
+        column = Column()
+        column.values = list(self.values)
+        column.typed_values = list(self.typed_values)
+        column.codes = array('I', self.codes)
+        column.compact()
+        return column
+
+    def to_json(self) -> Dict[str, List[Any]]:
+        return {"values": self.values[1:], "codes": self.codes.tolist()}
+
+    @classmethod
+    def from_json(cls, _json: Dict[str, List[Any]]) -> "Column":
+        column = cls()
+        column.values.extend(_json["values"])
+        column.typed_values.extend(parse_value(value) for value in _json["values"])
+        column.codes = array('I', _json["codes"])
+        column.compact()
+
+        if column.codes and max(column.codes) >= len(column.values):
+            raise ValueError("The column have codes without a value")
+        return column
+
+
+class TicketRow(Mapping):
+    """A read-only view of one row in the ticket table, which acts like the `dict` from `csv.DictReader`"""
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table: "TicketTable", index: int):
+        self._table = table
+        self._index = index
+
+    @property
+    def index(self) -> int:
+        return self._index
+
+    def __getitem__(self, key: str) -> Any:
+        column = self._table.columns[key]
+        code = column.codes[self._index]
+        if code == MISSING:
+            raise KeyError(key)
+        return column.values[code]
+
+    def typed(self, key: str) -> Any:
+        """Return: The value of the field as a `datetime`, `int` or `Decimal`, if it is one, see `parse_value`"""
+        column = self._table.columns[key]
+        code = column.codes[self._index]
+        if code == MISSING:
+            raise KeyError(key)
+        return column.typed_values[code]
+
+    def __iter__(self) -> Iterator[str]:
+        return (name for name, column in self._table.columns.items() if column.codes[self._index] != MISSING)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"TicketRow({dict(self)!r})"
+
+
+class TicketRows(Sequence):
+    """A read-only list of rows in the ticket table, only the row indices are stored"""
+    __slots__ = ("_table", "_indices")
+
+    def __init__(self, table: "TicketTable", indices: array):
+        self._table = table
+        self._indices = indices
+
+    @property
+    def indices(self) -> array:
+        return self._indices
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return TicketRows(self._table, self._indices[index])
+        return TicketRow(self._table, self._indices[index])
+
+    def __iter__(self) -> Iterator[TicketRow]:
+        return (TicketRow(self._table, index) for index in self._indices)
+
+    def __len__(self) -> int:
+        return len(self._indices)
+
+
+class TicketTable(Mapping):
+    """
+    All the tickets of an event stored column by column. It maps the name of the ticket type
+    (`Billettype`) to the rows of that ticket type, like the `TicketTypesType` dict used to.
+    """
+    fieldnames: List[str]
+    columns: Dict[str, Column]
+
+    def __init__(self, fieldnames: Iterable[str], columns: Optional[Iterable[str]] = None):
+        """
+        :param fieldnames: All the fields of the tickets (the header of the CSV file)
+        :param columns: The fields there is stored in the table, other fields in the rows are dropped.
+        All the fields are stored, if it is `None`
+        """
+        self.fieldnames = list(fieldnames)
+        self.columns = {name: Column() for name in (self.fieldnames if columns is None else columns)}
+        self._ticket_types: Dict[str, array] = {}
+        self._length = 0
+
+    def __len__(self) -> int:
+        return len(self._ticket_types)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._ticket_types)
+
+    def __getitem__(self, ticket_type_name: str) -> TicketRows:
+        return TicketRows(self, self._ticket_types[ticket_type_name])
+
+    @property
+    def row_count(self) -> int:
+        return self._length
+
+    @property
+    def rows(self) -> TicketRows:
+        return TicketRows(self, array('I', range(self._length)))
+
+    def row(self, index: int) -> TicketRow:
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        return TicketRow(self, index)
+
+    def add_ticket_type(self, ticket_type_name: str):
+        self._ticket_types.setdefault(ticket_type_name, array('I'))
+
+    def append(self, row: Mapping) -> int:
+        """Add a row to the table and return the index of it, the row is grouped by its `Billettype`"""
+        for name, column in self.columns.items():
+            if name in row:
+                column.append(row[name])
+            else:
+                column.append_missing()
+
+        index = self._length
+        self._length += 1
+        self._ticket_types.setdefault(row["Billettype"], array('I')).append(index)
+        return index
+
+    def compact(self):
+        """Free the memory only needed while adding rows, call it when all the rows are added"""
+        for column in self.columns.values():
+            column.compact()
+
+    def copy(self) -> "TicketTable":
+        """Return: A copy there can get more rows, without changing this table"""
+        table = TicketTable(self.fieldnames, columns=[])
+        table.columns = {name: column.copy() for name, column in self.columns.items()}
+        table._ticket_types = {name: array('I', indices) for name, indices in self._ticket_types.items()}
+        table._length = self._length
+        return table
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "fieldnames": self.fieldnames,
+            "columns": {name: column.to_json() for name, column in self.columns.items()},
+        }
+
+    @classmethod
+    def from_json(cls, _json: Dict[str, Any]) -> "TicketTable":
+        table = cls(_json["fieldnames"], columns=[])
+        table.columns = {name: Column.from_json(column) for name, column in _json["columns"].items()}
+
+        lengths = {len(column) for column in table.columns.values()}
+        if len(lengths) > 1:
+            raise ValueError("The columns in the ticket table don't have the same length")
+        table._length = lengths.pop() if lengths else 0
+
+        ticket_types = table.columns["Billettype"]
+        for index, code in enumerate(ticket_types.codes):
+            table._ticket_types.setdefault(ticket_types.values[code], array('I')).append(index)
+        return table
+
+
+class TicketIndex:
+    """
+    Indexes over the ticket table, there is built once after all the tickets are added,
+    so the reports for the unions don't have to go through all the tickets again.
+    """
+    table: TicketTable
+    unions: Dict[str, TicketRows]
+
+    def __init__(self, table: TicketTable, unions: Iterable[Any]):
+        """
+        :param table: All the tickets, including the manual tickets
+        :param unions: The unions from the config file
+        """
+        self.table = table
+        self.unions = {}
+        self._union_orders: Dict[str, Dict[str, TicketRows]] = {}
+        self._widths: Dict[Tuple[str, str], int] = {}
+        self._value_lengths: Dict[str, List[int]] = {}
+        self._texts: Dict[Tuple[str, Tuple[str, ...]], str] = {}
+
+        for union in unions:
+            indices = array('I')
+            orders: Dict[str, array] = {}
+            for ticket_type_name in union.ticket_type_names:
+                if ticket_type_name not in table:
+                    continue
+
+                for index in table[ticket_type_name].indices:
+                    indices.append(index)
+                    orders.setdefault(table.row(index)["Ordre"], array('I')).append(index)
+
+            self.unions[union.name] = TicketRows(table, indices)
+            self._union_orders[union.name] = {order: TicketRows(table, order_indices)
+                                              for order, order_indices in orders.items()}
+
+    def ticket_type(self, ticket_type_name: str) -> TicketRows:
+        return self.table[ticket_type_name]
+
+    def orders(self, union_name: str) -> Dict[str, TicketRows]:
+        """Return: The tickets of the union grouped by the order (`Ordre`), in the order they are bought"""
+        return self._union_orders[union_name]
+
+    def union_digest(self, union_name: str, columns: Iterable[str]) -> str:
+        """
+        Return: A hash of the values in the columns of the tickets of the union, in the same order as the tickets.
+        It only changes when the tickets of the union are changed
+        """
+        digest = sha256()
+        column_names = [name for name in dict.fromkeys(columns) if name in self.table.columns]
+        digest.update(repr(column_names).encode())
+
+        table_columns = [self.table.columns[name] for name in column_names]
+        for index in self.unions[union_name].indices:
+            digest.update(repr(tuple(column.values[column.codes[index]] for column in table_columns)).encode())
+        return digest.hexdigest()
+
+    def column_width(self, ticket_type_names: Iterable[str], column_name: str) -> int:
+        """
+        Return: The length of the longest value in the column from the tickets of the ticket types,
+        the manual tickets are not included
+        """
+        return max((self._ticket_type_column_width(ticket_type_name, column_name)
+                    for ticket_type_name in ticket_type_names if ticket_type_name in self.table), default=0)
+
+    def _ticket_type_column_width(self, ticket_type_name: str, column_name: str) -> int:
+        key = (ticket_type_name, column_name)
+        width = self._widths.get(key)
+        if width is None:
+            column = self.table.columns[column_name]
+            lengths = self._value_lengths.get(column_name)
+            if lengths is None:
+                lengths = [len(value) if isinstance(value, str) else 0 for value in column.values]
+                self._value_lengths[column_name] = lengths
+
+            orders = self.table.columns["Ordre"]
+            manual_ticket_code = orders.find("manual-ticket")
+            width = max((lengths[column.codes[index]] for index in self.table[ticket_type_name].indices
+                         if orders.codes[index] != manual_ticket_code), default=0)
+            self._widths[key] = width
+        return width
+
+    def ticket_type_text(self, ticket_type_name: str, fields: Iterable[str]) -> str:
+        """
+        Return: The tickets of the ticket type as a text table with the fields as columns, in the same format
+        as `tabulate(data, headers=fields)`. It is only rendered once per run for each ticket type and fields,
+        so the unions with the same ticket types share it. It raises `KeyError` if a ticket doesn't have a field
+        """
+        key = (ticket_type_name, tuple(fields))
+        text = self._texts.get(key)
+        if text is None:
+            text = self._render_text(*key)
+            self._texts[key] = text
+        return text
+
+    def _render_text(self, ticket_type_name: str, fields: Tuple[str, ...]) -> str:
+        # tabulate is only imported when the first table is rendered, so it isn't imported at startup
+        from tabulate import tabulate
+
+        indices = self.table[ticket_type_name].indices
+        columns = [self.table.columns[field] for field in fields]
+        # A row is identified by the codes of its values, most of the tickets have the same values in some columns
+        rows = [tuple(column.codes[index] for column in columns) for index in indices]
+        distinct_rows = list(dict.fromkeys(rows))
+        for field, codes in zip(fields, zip(*distinct_rows)):
+            if MISSING in codes:
+                raise KeyError(field)
+
+        data = [[column.values[code] for column, code in zip(columns, row)] for row in distinct_rows]
+        if any(MULTILINE_PATTERN.search(text) for text in fields) or any(
+                isinstance(value, str) and MULTILINE_PATTERN.search(value) for values in data for value in values):
+            # A value with more than one line is shown over more lines, so each ticket doesn't have one line
+            return tabulate([[ticket[field] for field in fields] for ticket in self.table[ticket_type_name]],
+                            headers=fields)
+
+        # The widths and the alignment of the columns only depend on the distinct values, so a ticket is shown
+        # with the same line as its distinct row, and only the distinct rows are rendered by tabulate
+        lines = tabulate(data, headers=fields).split("\n")
+        row_lines = dict(zip(distinct_rows, lines[2:]))
+        return "\n".join(lines[:2] + [row_lines[row] for row in rows])
+
+
+class TestTicketTable(unittest.TestCase):
+    def test_10_parse_value(self):
+        self.assertEqual(parse_value("1.234,50"), Decimal("1234.50"))
+        self.assertEqual(parse_value("-12,5"), Decimal("-12.5"))
+        self.assertEqual(parse_value("300"), 300)
+        self.assertEqual(parse_value("2024-06-01T12:00:00"), datetime(2024, 6, 1, 12))
+        self.assertEqual(parse_value("1.2.3"), "1.2.3")
+        self.assertEqual(parse_value("12.34"), "12.34")
+        self.assertEqual(parse_value("0"), 0)
+        self.assertEqual(parse_value("0800"), "0800")
+        self.assertEqual(parse_value("012.345"), "012.345")
+
+    def test_20_grouped_prices(self):
+        table = TicketTable(["Billettype", "Pris"])
+        for price in ("1.234", "1.234.567", "1.234,50", "-1.000"):
+            table.append({"Billettype": price, "Pris": price})
+
+        self.assertEqual([table[price][0].typed("Pris") for price in table],
+                         [1234, 1234567, Decimal("1234.50"), -1000])
+        self.assertEqual(float(table["1.234"][0].typed("Pris")), 1234.0)
+        self.assertEqual(table["1.234"][0]["Pris"], "1.234")
+
+
+class TestTicketIndex(unittest.TestCase):
+    def test_10_same_text_as_tabulate(self):
+        from types import SimpleNamespace
+        from tabulate import tabulate
+
+        columns = {
+            "Negative": ["-5", "10", "", "7"],
+            "Decimal": ["1.5", "22.75", "3", "1e5"],
+            "Phone": ["+4512345678", "12345678", "", "004512"],
+            "Nan": ["nan", "1", "2", "3"],
+            "Underscore": ["1_000", "2", "3", "4"],
+            "Bool": ["True", "False", "True", "False"],
+            "Mixed": ["True", "5", "", "6"],
+            "Pris": ["1.234,50", "300,00", "1.234", "12"],
+            "Navn": ["Æøå", "😀 Emoji", " spaces ", "日本"],
+            "Empty": ["", "", "", ""],
+            "Lines": ["one\ntwo", "three", "", "x"],
+        }
+        fieldnames = ["Billettype", "Ordre", *columns]
+        table = TicketTable(fieldnames)
+        # The same values more than once, like the tickets of the same order
+        for row in (0, 1, 2, 3, 0, 2, 2):
+            table.append({"Billettype": "Voksen", "Ordre": str(row),
+                          **{name: values[row] for name, values in columns.items()}})
+        ticket_index = TicketIndex(table, [SimpleNamespace(name="Union1", ticket_type_names=["Voksen"])])
+
+        for fields in (("Negative", "Navn"), ("Phone", "Nan", "Underscore", "Navn"), ("Decimal", "Navn"),
+                       ("Bool", "Mixed", "Pris", "Empty"), ("Navn", "Lines"), ("Ordre", "Pris", "Navn")):
+            with self.subTest(fields=fields):
+                data = [[ticket[field] for field in fields] for ticket in table["Voksen"]]
+                self.assertEqual(ticket_index.ticket_type_text("Voksen", fields), tabulate(data, headers=fields))
+
+
+if __name__ == '__main__':
+    unittest.main()